@@ -0,0 +1,441 @@
+from __future__ import division, absolute_import, print_function
+import argparse
+import hashlib
+import multiprocessing
+import os
+import re
+import tempfile
+import resource
+import time
+from math import pi, sin, cos, ceil
+
+import numpy as np
+from pyproj import Proj
+from pyqtree import Index
+from Converter import Converter
+from GridIndex import GridIndex
+from Utils import unique_ids
+from opendrivepy.opendrive import OpenDrive
+from opendrivepy.point import Point
+from opendrivepy.projection import utm_zone
+from opendrivepy.roadmap import segment_distance
+
+# Benchmarks for the parsing / conversion pipeline
+# Every measurement that reports memory runs in a fresh process, so that the
+# peak RSS of one mode is not hidden by the other
+
+
+def peak_rss():
+    # ru_maxrss is reported in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_isolated(func, *args):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def measure_parse(filename, stream):
+    base = peak_rss()
+    start = time.time()
+    opendrive = OpenDrive(filename, stream)
+    elapsed = time.time() - start
+    return elapsed, base, peak_rss(), len(opendrive.roads), len(opendrive.junctions)
+
+
+def bench_parse(args):
+    filename = RESOURCE_PATH + args.input_file
+    print("Parsing %s, %d repeat(s)" % (filename, args.repeat))
+    print("%-10s %10s %14s %14s %8s %10s" % ('mode', 'time(s)', 'peak RSS(MB)', 'parse RSS(MB)', 'roads', 'junctions'))
+    for stream in (False, True):
+        results = [run_isolated(measure_parse, filename, stream) for _ in range(args.repeat)]
+        elapsed = min(r[0] for r in results)
+        base = min(r[1] for r in results)
+        peak = min(r[2] for r in results)
+        print("%-10s %10.3f %14.1f %14.1f %8d %10d" % ('iterparse' if stream else 'dom', elapsed,
+              peak / 1024, (peak - base) / 1024, results[0][3], results[0][4]))
+
+
+# Scalar per-point samplers, as they were before the NumPy sampling path
+# Kept as the reference the vectorized samplers are checked and timed against
+def legacy_line_points(record):
+    points = list()
+    array = [n for n in range(0, int(ceil(record.length)+1))]
+    array[-1] = record.length
+    for n in array:
+        x = record.x + (n * cos(record.hdg))
+        y = record.y + (n * sin(record.hdg))
+        points.append(Point(x, y, record.s + n, record.hdg))
+    return points
+
+
+def legacy_arc_points(record):
+    points = list()
+    n = int(ceil(record.length)+1)
+    angle = record.length / record.radius
+    sign = 1 if record.curvature > 0 else -1
+    start_angle = record.hdg + sign * (pi / 2)
+    circle_x = record.x + (cos(start_angle) * record.radius)
+    circle_y = record.y + (sin(start_angle) * record.radius)
+    array = list(range(n))
+    angle_list = [start_angle - sign * pi + sign * (angle * x / (n-1)) for x in array]
+    angle_list[-1] = start_angle - sign * pi + sign * angle
+    array[-1] = record.length
+    for a, s in zip(angle_list, array):
+        x = circle_x + (record.radius * cos(a))
+        y = circle_y + (record.radius * sin(a))
+        points.append(Point(x, y, record.s + s, a + sign * pi / 2))
+    return points
+
+
+def legacy_spiral_points(record):
+    # two scalar fresnel calls per sample, the heading is a finite difference
+    points = list()
+    ox, oy, theta = record.odr_spiral(record.spiralS)
+    sin_rot, cos_rot = sin(theta), cos(theta)
+    sin_hdg, cos_hdg = sin(record.hdg), cos(record.hdg)
+    array = [n for n in range(0, int(ceil(record.length)+1))]
+    array[-1] = record.length
+    for i in array:
+        coords = list()
+        for ds in (i, i + pi/180):
+            tx, ty, _ = record.odr_spiral(ds + record.spiralS)
+            dx, dy = tx - ox, ty - oy
+            lx, ly = dx * cos_rot + dy * sin_rot, dy * cos_rot - dx * sin_rot
+            coords.append((record.x + cos_hdg * lx - sin_hdg * ly, record.y + cos_hdg * ly + sin_hdg * lx))
+        angle = np.arctan2(coords[1][1] - coords[0][1], coords[1][0] - coords[0][0])
+        points.append(Point(coords[0][0], coords[0][1], record.s + i, angle))
+    return points
+
+
+LEGACY_SAMPLERS = {'line': legacy_line_points, 'arc': legacy_arc_points, 'spiral': legacy_spiral_points}
+
+
+def bench_sample(args):
+    filename = RESOURCE_PATH + args.input_file
+    print("Sampling the geometry records of %s, %d repeat(s)" % (filename, args.repeat))
+    opendrive = OpenDrive(filename)
+    records = dict()
+    for road in opendrive.roads.values():
+        for record in road.plan_view:
+            records.setdefault(record.style, list()).append(record)
+
+    print("%-8s %8s %10s %12s %12s %12s %10s %12s" % ('style', 'records', 'points', 'legacy(s)', 'arrays(s)', 'points(s)',
+                                                     'max err(m)', 'max hdg(rad)'))
+    for style, style_records in sorted(records.items()):
+        npoints = sum(len(record.s_array) for record in style_records)
+
+        vectorized = min_time(args.repeat, lambda: [record.generate_coords() for record in style_records])
+        with_points = min_time(args.repeat, lambda: [(record.generate_coords(), record.points) for record in style_records])
+
+        legacy = LEGACY_SAMPLERS.get(style)
+        if legacy is None:
+            print("%-8s %8d %10d %12s %12.4f %12.4f %10s %12s" % (style, len(style_records), npoints, '-', vectorized, with_points, '-', '-'))
+            continue
+        legacy_time = min_time(args.repeat, lambda: [legacy(record) for record in style_records])
+        error = 0
+        heading_error = 0
+        for record in style_records:
+            for old, new in zip(legacy(record), record.points):
+                error = max(error, abs(old.x - new.x), abs(old.y - new.y), abs(old.s - new.s))
+                heading_error = max(heading_error, abs((old.rad - new.rad + pi) % (2 * pi) - pi))
+        print("%-8s %8d %10d %12.4f %12.4f %12.4f %10.1e %12.1e" % (style, len(style_records), npoints, legacy_time, vectorized,
+                                                            with_points, error, heading_error))
+
+
+# The node deduplication of Converter.add_node over a spatial index: query the
+# point, reuse the first node found or insert a new box of +-min_distance
+def dedup_nodes(spindex, points, min_distance):
+    ids = list()
+    count = 0
+    for x, y in points:
+        near_node_ids = spindex.intersect((x, y, x, y))
+        if len(near_node_ids) > 0:
+            ids.append(near_node_ids[0])
+        else:
+            spindex.insert(count, (x-min_distance, y-min_distance, x+min_distance, y+min_distance))
+            ids.append(count)
+            count += 1
+    return ids, count
+
+
+def bench_dedup(args):
+    # lane samples every meter over an area sized for the requested node count,
+    # a fifth of them sampled again nearby, as the shared borders of lanes and roads
+    rng = np.random.default_rng(args.seed)
+    side = np.sqrt(args.nodes)
+    points = rng.uniform(0, side, (args.nodes, 2))
+    again = rng.choice(args.nodes, args.nodes // 5, replace=False)
+    points[again] = points[rng.choice(args.nodes, len(again))] + rng.uniform(-args.min_distance, args.min_distance, (len(again), 2))
+    points = points.tolist()
+    print("Deduplicating %d nodes over %.0fm x %.0fm, min distance %gm" % (args.nodes, side, side, args.min_distance))
+    print("%-10s %10s %10s %14s" % ('index', 'time(s)', 'nodes', 'us per node'))
+
+    results = dict()
+    for name in ('gridhash', 'pyqtree'):
+        if name == 'pyqtree':
+            spindex = Index(bbox=(0, 0, side, side))
+        else:
+            spindex = GridIndex(2 * args.min_distance)
+        start = time.time()
+        results[name] = dedup_nodes(spindex, points, args.min_distance)
+        elapsed = time.time() - start
+        print("%-10s %10.3f %10d %14.2f" % (name, elapsed, results[name][1], elapsed / args.nodes * 1e6))
+    print("same nodes: %s" % (results['gridhash'][1] == results['pyqtree'][1]))
+
+
+SINGLE_ROAD_XODR = """<?xml version="1.0" encoding="UTF-8"?>
+<OpenDRIVE>
+    <header revMajor="1" revMinor="4" name="single road" version="1"/>
+    <road name="Road 0" length="{length}" id="0" junction="-1">
+        <planView>
+            <geometry s="0" x="0" y="0" hdg="0" length="{length}"><line/></geometry>
+        </planView>
+        <elevationProfile>
+            <elevation s="0" a="0" b="0" c="0" d="0"/>
+        </elevationProfile>
+        <lanes>
+            <laneSection s="0">
+                <left>{left}</left>
+                <center><lane id="0" type="none" level="false"/></center>
+                <right>{right}</right>
+            </laneSection>
+        </lanes>
+    </road>
+</OpenDRIVE>
+"""
+SINGLE_ROAD_LANE = '<lane id="{id}" type="driving" level="false"><width sOffset="0" a="3.5" b="0" c="0" d="0"/></lane>'
+
+
+# The way node lists as they were built, each add_node result checked against
+# the list so far
+def legacy_way_nodes(ids):
+    way_nodes_id = list()
+    for new_node_id in ids:
+        if not (new_node_id in way_nodes_id):
+            way_nodes_id.append(new_node_id)
+    return way_nodes_id
+
+
+def single_road_converter(length, lanes, min_distance):
+    # a straight road of the given length, converted with the OSM converter
+    lanes = range(1, lanes + 1)
+    xodr = SINGLE_ROAD_XODR.format(length=length,
+                                   left=''.join(SINGLE_ROAD_LANE.format(id=i) for i in lanes),
+                                   right=''.join(SINGLE_ROAD_LANE.format(id=-i) for i in lanes))
+    handle, filename = tempfile.mkstemp(suffix='.xodr')
+    with os.fdopen(handle, 'w') as f:
+        f.write(xodr)
+    try:
+        start = time.time()
+        converter = Converter(filename, 10000, min_distance)
+        elapsed = time.time() - start
+    finally:
+        os.remove(filename)
+    return converter, elapsed
+
+
+def bench_ways(args):
+    converter, elapsed = single_road_converter(args.length, args.lanes, args.min_distance)
+    print("Single %gm road, %d lanes: %d nodes, %d ways, converted in %.3fs" % (args.length, 2 * args.lanes,
+          len(converter.nodes), len(converter.ways), elapsed))
+
+    # the add_node results of each lane, the way nodes with the end repeated
+    streams = [way.nodes_id + way.nodes_id[-1:] for way in converter.ways.values()]
+    print("%-12s %10s" % ('way build', 'time(s)'))
+    print("%-12s %10.4f" % ('list', min_time(args.repeat, lambda: [legacy_way_nodes(ids) for ids in streams])))
+    print("%-12s %10.4f" % ('unique_ids', min_time(args.repeat, lambda: [unique_ids(ids) for ids in streams])))
+
+
+# Converter.generate_osm as it was, building the whole ElementTree before writing it
+# (on the UTM zone of the map origin, as the converter now projects)
+def legacy_generate_osm(converter, filename):
+    import xml.etree.ElementTree as ET
+    from datetime import datetime
+    wgs84_to_utm = Proj(proj='utm', zone=utm_zone(converter.opendrive.lon), south=converter.opendrive.lat < 0,
+                        ellps='WGS84')
+    base_utmx, base_utmy = wgs84_to_utm(converter.opendrive.lon, converter.opendrive.lat)
+    osm_root = ET.Element('osm', {'version': "0.6", 'generator': "xodr_OSM_converter", 'copyright': "Simon",
+                                  'attribution': "Simon", 'license': "GNU or whatever"})
+    ET.SubElement(osm_root, 'bounds', {'minlat': '0', 'minlon': '0', 'maxlat': '1', 'maxlon': '1'})
+    for node in converter.nodes:
+        node_x, node_y = wgs84_to_utm(base_utmx+node.x, base_utmy+node.y, inverse=True)
+        node_attrib = {'id': str(node.id+1), 'visible': 'true', 'version': '1', 'changeset': '1', 'timestamp': datetime.utcnow().strftime(
+            '%Y-%m-%dT%H:%M:%SZ'), 'user': 'simon', 'uid': '1', 'lon': str(node_x), 'lat': str(node_y), 'ele': '2'}
+        node_root = ET.SubElement(osm_root, 'node', node_attrib)
+        ET.SubElement(node_root, 'tag', {'k': "type", 'v': 'Smart'})
+        ET.SubElement(node_root, 'tag', {'k': "height", 'v': str(node.z)})
+        ET.SubElement(node_root, 'tag', {'k': "minArcRadius", 'v': str(node.max_arcrad)})
+    for index, way_id in enumerate(converter.ways):
+        way_value = converter.ways[way_id]
+        way_attrib = {'id': str(index+1), 'version': '1', 'changeset': '1',
+                      'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), 'user': 'simon', 'uid': '1'}
+        way_root = ET.SubElement(osm_root, 'way', way_attrib)
+        for way_node in way_value.nodes_id:
+            ET.SubElement(way_root, 'nd', {'ref': str(way_node+1)})
+        ET.SubElement(way_root, 'tag', {'k': "name", 'v': 'road'+str(way_value.id)})
+        ET.SubElement(way_root, 'tag', {'k': "streetWidth", 'v': str(way_value.width)})
+        ET.SubElement(way_root, 'tag', {'k': "streetOffset", 'v': str(way_value.offset)})
+        ET.SubElement(way_root, 'tag', {'k': "sidewalkWidthLeft", 'v': str(way_value.widthleftwalk)})
+        ET.SubElement(way_root, 'tag', {'k': "sidewalkWidthRight", 'v': str(way_value.widthrightwalk)})
+        ET.SubElement(way_root, 'tag', {'k': "NbrOfRightLanes", 'v': str(way_value.nrightlanes)})
+        ET.SubElement(way_root, 'tag', {'k': "nLanesTotal", 'v': str(way_value.nrightlanes + way_value.nleftlanes)})
+        if way_value.nrightlanes == 0 or way_value.nleftlanes == 0:
+            ET.SubElement(way_root, 'tag', {'k': "Centerline", 'v': "none"})
+    ET.ElementTree(osm_root).write(filename)
+
+
+def measure_osm(length, lanes, min_distance, streaming):
+    converter, _ = single_road_converter(length, lanes, min_distance)
+    handle, filename = tempfile.mkstemp(suffix='.osm')
+    os.close(handle)
+    try:
+        base = peak_rss()
+        start = time.time()
+        if streaming:
+            converter.generate_osm(filename)
+        else:
+            legacy_generate_osm(converter, filename)
+        elapsed = time.time() - start
+        peak = peak_rss()
+        with open(filename) as f:
+            content = re.sub('timestamp="[^"]*"', '', f.read())
+    finally:
+        os.remove(filename)
+    return elapsed, base, peak, len(converter.nodes), len(content), hashlib.md5(content.encode()).hexdigest()
+
+
+def bench_osm(args):
+    print("OSM output of a single %gm road with %d lanes" % (args.length, 2 * args.lanes))
+    print("%-12s %10s %10s %14s %14s" % ('writer', 'nodes', 'time(s)', 'peak RSS(MB)', 'write RSS(MB)'))
+    contents = list()
+    for streaming in (False, True):
+        elapsed, base, peak, nodes, size, content = run_isolated(measure_osm, args.length, args.lanes, args.min_distance, streaming)
+        contents.append(content)
+        print("%-12s %10d %10.3f %14.1f %14.1f" % ('streaming' if streaming else 'elementtree', nodes, elapsed,
+                                                  peak / 1024, (peak - base) / 1024))
+    print("same output: %s (%.1f MB)" % (contents[0] == contents[1], size / 1024 / 1024))
+
+
+def bench_pbf(args):
+    converter, _ = single_road_converter(args.length, args.lanes, args.min_distance)
+    print("OSM output of a single %gm road with %d lanes, %d nodes" % (args.length, 2 * args.lanes, len(converter.nodes)))
+    print("%-12s %10s %12s" % ('format', 'time(s)', 'size(MB)'))
+    for format in ('osm', 'pbf'):
+        handle, filename = tempfile.mkstemp(suffix='.' + format)
+        os.close(handle)
+        try:
+            elapsed = min_time(args.repeat, lambda: converter.generate_osm(filename, format=format))
+            size = os.path.getsize(filename)
+        finally:
+            os.remove(filename)
+        print("%-12s %10.3f %12.2f" % (format, elapsed, size / 1024 / 1024))
+
+
+# The closest segments by scanning all of them, as RoadMap.closest_point did
+def brute_closest_segments(roadmap, x, y):
+    closest = list()
+    for qx, qy in zip(x, y):
+        distance, side = segment_distance(roadmap.x1, roadmap.y1, roadmap.x2, roadmap.y2, qx, qy)
+        width = np.where(side > 0, roadmap.left, np.where(side < 0, roadmap.right, np.maximum(roadmap.left, roadmap.right)))
+        distance = np.where(distance <= width, distance, np.inf)
+        closest.append(int(np.argmin(distance)) if np.isfinite(distance).any() else -1)
+    return np.array(closest)
+
+
+def bench_roadmap(args):
+    filename = RESOURCE_PATH + args.input_file
+    opendrive = OpenDrive(filename)
+    roadmap = opendrive.roadmap
+    start = time.time()
+    roadmap.build()
+    print("R-tree of the %d segments of %s built in %.3fs" % (len(roadmap.tree), filename, time.time() - start))
+
+    # points spread over the bounding box of the roads
+    rng = np.random.default_rng(args.seed)
+    x = rng.uniform(min(roadmap.x1.min(), roadmap.x2.min()), max(roadmap.x1.max(), roadmap.x2.max()), args.queries)
+    y = rng.uniform(min(roadmap.y1.min(), roadmap.y2.min()), max(roadmap.y1.max(), roadmap.y2.max()), args.queries)
+    print("%-10s %10s %10s %14s" % ('query', 'points', 'time(s)', 'points per s'))
+    batch = min_time(args.repeat, lambda: roadmap.closest_segments(x, y))
+    print("%-10s %10d %10.3f %14.0f" % ('arrays', args.queries, batch, args.queries / batch))
+    count = min(args.queries, 10000)
+    single = min_time(args.repeat, lambda: [roadmap.is_on_road(Point(qx, qy)) for qx, qy in zip(x[:count], y[:count])])
+    print("%-10s %10d %10.3f %14.0f" % ('points', count, single, count / single))
+    opendrive.match(np.column_stack([x[:1], y[:1]]))
+    match = min_time(args.repeat, lambda: opendrive.match(np.column_stack([x, y]), workers=args.workers))
+    print("%-10s %10d %10.3f %14.0f" % ('match', args.queries, match, args.queries / match))
+
+    count = min(args.queries, 1000)
+    closest, distance = roadmap.closest_segments(x[:count], y[:count])
+    brute = brute_closest_segments(roadmap, x[:count], y[:count])
+    # equally close segments may be found in another order
+    same = (closest == brute) | ((closest >= 0) & (brute >= 0) & np.isclose(
+        distance, segment_distance(roadmap.x1[brute], roadmap.y1[brute], roadmap.x2[brute], roadmap.y2[brute],
+                                   x[:count], y[:count])[0]))
+    print("on the roads: %.1f%%, same as the full scan: %s" % (100 * np.mean(closest >= 0), bool(same.all())))
+
+
+def min_time(repeat, func):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+RESOURCE_PATH = "../resource/"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of the xodr-OSM converter')
+    subparsers = parser.add_subparsers(dest='bench')
+    subparsers.required = True
+
+    parse_parser = subparsers.add_parser('parse', help='Time and peak RSS of the DOM and iterparse parsers')
+    parse_parser.add_argument('--input_file', type=str, default='field_noround.xodr', help='Input OpenDRIVE file name')
+    parse_parser.add_argument('--repeat', type=int, default=3, help='Number of runs per mode, the best one is reported')
+    parse_parser.set_defaults(func=bench_parse)
+
+    sample_parser = subparsers.add_parser('sample', help='Time of the geometry samplers against the scalar ones')
+    sample_parser.add_argument('--input_file', type=str, default='Town03.xodr', help='Input OpenDRIVE file name')
+    sample_parser.add_argument('--repeat', type=int, default=5, help='Number of runs, the best one is reported')
+    sample_parser.set_defaults(func=bench_sample)
+
+    dedup_parser = subparsers.add_parser('dedup', help='Node deduplication with the grid hash against pyqtree')
+    dedup_parser.add_argument('--nodes', type=int, default=1000000, help='Number of nodes to add')
+    dedup_parser.add_argument('--min_distance', type=float, default=0.1, help='Distance under which nodes are merged (in meter)')
+    dedup_parser.add_argument('--seed', type=int, default=0, help='Seed of the random nodes')
+    dedup_parser.set_defaults(func=bench_dedup)
+
+    ways_parser = subparsers.add_parser('ways', help='Way node list construction on a long single road')
+    ways_parser.add_argument('--length', type=float, default=10000, help='Length of the road (in meter)')
+    ways_parser.add_argument('--lanes', type=int, default=2, help='Number of driving lanes on each side')
+    ways_parser.add_argument('--min_distance', type=float, default=0.1, help='Distance under which nodes are merged (in meter)')
+    ways_parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the best one is reported')
+    ways_parser.set_defaults(func=bench_ways)
+
+    osm_parser = subparsers.add_parser('osm', help='Time and peak RSS of the OSM XML writers')
+    osm_parser.add_argument('--length', type=float, default=100000, help='Length of the road (in meter)')
+    osm_parser.add_argument('--lanes', type=int, default=5, help='Number of driving lanes on each side')
+    osm_parser.add_argument('--min_distance', type=float, default=0.1, help='Distance under which nodes are merged (in meter)')
+    osm_parser.set_defaults(func=bench_osm)
+
+    pbf_parser = subparsers.add_parser('pbf', help='Time and size of the OSM XML and PBF outputs')
+    pbf_parser.add_argument('--length', type=float, default=100000, help='Length of the road (in meter)')
+    pbf_parser.add_argument('--lanes', type=int, default=5, help='Number of driving lanes on each side')
+    pbf_parser.add_argument('--min_distance', type=float, default=0.1, help='Distance under which nodes are merged (in meter)')
+    pbf_parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the best one is kept')
+    pbf_parser.set_defaults(func=bench_pbf)
+
+    roadmap_parser = subparsers.add_parser('roadmap', help='Closest road segment queries and map matching of the RoadMap')
+    roadmap_parser.add_argument('--input_file', type=str, default='Town03.xodr', help='Input OpenDRIVE file name')
+    roadmap_parser.add_argument('--queries', type=int, default=100000, help='Number of query points')
+    roadmap_parser.add_argument('--seed', type=int, default=0, help='Seed of the query points')
+    roadmap_parser.add_argument('--repeat', type=int, default=3, help='Number of runs, the best one is reported')
+    roadmap_parser.add_argument('--workers', type=int, default=1, help='Number of threads of the map matching KD-tree queries, -1 for all')
+    roadmap_parser.set_defaults(func=bench_roadmap)
+
+    args = parser.parse_args()
+    args.func(args)
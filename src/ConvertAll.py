@@ -0,0 +1,85 @@
+from __future__ import division, absolute_import, print_function
+import argparse
+
+from opendrivepy.cache import ModelCache, load_opendrive
+from RoadWorkers import all_lane_lines
+from Converter import Converter as OSMConverter
+from Converter_to_csv import Converter as CSVConverter
+from Converter_center import Converter as CenterConverter
+from TableWriter import FORMATS
+
+# One pass for all the outputs: the OpenDRIVE file is parsed and sampled once,
+# and the lane centre lines computed once for the OSM and the semantic map
+# The converters keep their own nodes and ways, they run one after the other
+# (they number the ways of the shared roads) and are dropped once written
+
+OUTPUTS = ['osm', 'csv', 'center']
+
+
+def convert_all(filename, output_file, outputs, scene_scale, min_distance, stream=False, adaptive=False,
+                bulk_merge=False, workers=1, osm_format='osm', table_format='csv', debug=False, cache=None,
+                junctions=False):
+    max_error = min_distance if adaptive else None
+    print("Reading OpenDrive file: " + filename)
+    opendrive = load_opendrive(filename, stream, max_error, cache)
+    lane_lines = None
+    if 'osm' in outputs or 'csv' in outputs:
+        lane_lines = list(all_lane_lines(opendrive, workers, filename, stream, max_error, cache))
+
+    if 'osm' in outputs:
+        converter = OSMConverter(filename, scene_scale, min_distance, stream, adaptive, bulk_merge, workers,
+                                 opendrive, lane_lines, junctions=junctions)
+        converter.generate_osm(output_file + '.' + osm_format, debug, osm_format)
+    if 'csv' in outputs:
+        converter = CSVConverter(filename, scene_scale, min_distance, stream, adaptive, bulk_merge, workers,
+                                 opendrive, lane_lines)
+        converter.generate_osm(output_file, debug, table_format)
+    if 'center' in outputs:
+        converter = CenterConverter(filename, scene_scale, min_distance, stream, adaptive, bulk_merge, opendrive,
+                                    workers=workers)
+        converter.generate_osm(output_file + '_center', debug)
+
+
+def output_list(text):
+    outputs = [output.strip() for output in text.split(',') if output.strip()]
+    for output in outputs:
+        if output not in OUTPUTS:
+            raise argparse.ArgumentTypeError("unknown output %s, choose from %s" % (output, ','.join(OUTPUTS)))
+    return outputs
+
+
+RESOURCE_PATH = "../resource/"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Converts an OpenDRIVE file to several outputs in one pass')
+    parser.add_argument('--debug', type=bool, default=False, help='Is using debug mode')
+    parser.add_argument('--input_file', type=str, default='testfield_no_roundabout.xodr', help='Input OpenDRIVE file name')
+    parser.add_argument('--scale', type=int, default=10000, help='Scale of xodr file (in meter)')
+    parser.add_argument('--precise', type=float, default=0.1, help='Precision of OSM file (in meter)')
+    parser.add_argument('--output_file', type=str, default='example', help='Output file name, without extension')
+    parser.add_argument('--outputs', type=output_list, default=OUTPUTS,
+                        help='Comma separated outputs: osm (OSM file), csv (semantic road map), center (road centerlines)')
+    parser.add_argument('--stream', action='store_true', help='Parse the OpenDRIVE file with iterparse instead of loading the whole DOM')
+    parser.add_argument('--adaptive', action='store_true', help='Sample the roads adaptively, with a chord error up to --precise, instead of every meter')
+    parser.add_argument('--bulk_merge', action='store_true', help='Merge the nodes closer than --precise in one KD-tree pass after sampling all the roads')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes sampling the roads and computing their lane centre lines')
+    parser.add_argument('--osm_format', type=str, default='osm', choices=['osm', 'pbf'], help='Format of the OSM file, OSM XML or OSM PBF')
+    parser.add_argument('--table_format', type=str, default='csv', choices=FORMATS, help='Format of the semantic road map tables')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory of the cache of the built OpenDRIVE models, no cache by default')
+    parser.add_argument('--cache_size', type=int, default=1024, help='Size of the model cache (in MB), the least recently used models are removed beyond it')
+    parser.add_argument('--incremental', action='store_true', help='Reuse the roads, junctions and lane centre lines of the <road> and <junction> elements unchanged since the last conversion of the file (needs --cache_dir)')
+    parser.add_argument('--junctions', action='store_true', help='Merge the ends of the lanes meeting in the junctions in a single node (OSM output)')
+    args = parser.parse_args()
+    if args.incremental and not args.cache_dir:
+        parser.error('--incremental needs --cache_dir')
+    print(args)
+
+    print('Start converting file...')
+
+    cache = ModelCache(args.cache_dir, args.cache_size * 1024 * 1024, args.incremental) if args.cache_dir else None
+
+    convert_all(RESOURCE_PATH + args.input_file, RESOURCE_PATH + args.output_file, args.outputs, args.scale, args.precise,
+                args.stream, args.adaptive, args.bulk_merge, args.workers, args.osm_format, args.table_format, args.debug, cache,
+                args.junctions)
+
+    print('All done')
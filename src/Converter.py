@@ -3,16 +3,20 @@ import xml.etree.ElementTree as ET
 from math import fabs, sqrt, sin, cos, pi
 import matplotlib.pyplot as plt
 from datetime import datetime
+import numpy as np
 
-from opendrivepy.opendrive import OpenDrive
+from opendrivepy.cache import ModelCache, load_opendrive
 from opendrivepy.point import Point
 from tqdm import tqdm
-from pyqtree import Index
+from GridIndex import GridIndex
+from NodeMerge import merge_points, remap_ways
+from RoadWorkers import all_lane_lines
+from OSMWriter import OSMWriter
+from PBFWriter import PBFWriter
 
 from OSMtype import *
 from Utils import *
 import argparse
-from pyproj import Proj
 
 # To avoid the conflict between nodes
 # Any points that is too close with peer ( < min distance ) are discarded
@@ -22,13 +26,34 @@ MAX_ARC_RADIUS = 50
 class Converter(object):
     """docstring for Converter"""
 
-    def __init__(self, filename, scene_scale, min_distance):
+    def __init__(self, filename, scene_scale, min_distance, stream=False, adaptive=False, bulk_merge=False, workers=1,
+                 opendrive=None, lane_lines=None, cache=None, junctions=False):
         super(Converter, self).__init__()
 
-        print("Reading OpenDrive file: " + filename)
-        self.opendrive = OpenDrive(filename)
+        # adaptive sampling keeps the sampled lanes within min_distance of the real ones
+        self.filename = filename
+        self.stream = stream
+        self.max_error = min_distance if adaptive else None
+        # the built models are reused from the cache (a ModelCache) when there is one
+        self.cache = cache
+        # the map and its lane centre lines can be shared with the other converters
+        if opendrive is None:
+            print("Reading OpenDrive file: " + filename)
+            opendrive = load_opendrive(filename, stream, self.max_error, cache)
+        self.opendrive = opendrive
+        self.lane_lines = lane_lines
         self.scale, minx, miny, maxx, maxy = self.set_scale(scene_scale)
         self.min_distance = min_distance
+        # merge the road samples in one pass after the roads instead of one by one
+        self.bulk_merge = bulk_merge
+        self.samples = list()
+        # processes computing the lane centre lines of the roads
+        self.workers = workers
+        # merge the lane ends meeting in the junctions in a single node
+        self.junctions = junctions
+        # road id -> side ('l'/'r') -> lane section -> ways of its driving
+        # lanes, from the centre line out
+        self.lane_ways = dict()
         # print(self.scale)
 
         print("Converting...")
@@ -36,7 +61,8 @@ class Converter(object):
         self.ways = dict()
         self.nodes = list()
 
-        self.spindex = Index(bbox=(minx, miny, maxx, maxy))
+        # the nodes are boxes of +-min_distance around them
+        self.spindex = GridIndex(2 * self.min_distance)
         self.convert()
 
     def set_scale(self, scene_scale):
@@ -64,12 +90,20 @@ class Converter(object):
 
         return scene_scale, minx, miny, maxx, maxy
 
+    # the lane centre lines of all the roads, in road order
+    def all_lane_lines(self):
+        if self.lane_lines is not None:
+            return self.lane_lines
+        return all_lane_lines(self.opendrive, self.workers, self.filename, self.stream, self.max_error, self.cache)
+
     def convert(self):
         # 1. convert all roads into nodes+ways
+        # The lane centre lines may come from worker processes, the nodes and
+        # ways are numbered here, in road order, as with a single process
         way_id = 0
         junction_list=dict()
         with tqdm(total=len(self.opendrive.roads), ascii=True) as pbar:
-            for road_id, road in self.opendrive.roads.items():
+            for (road_id, road), lane_lines in zip(self.opendrive.roads.items(), self.all_lane_lines()):
                 # road.points=list(set(road.points))
                 # road.points.sort(key=lambda x:x.s)
                 # id_list={"444","430","742"}#"118",}#"119"}
@@ -106,36 +140,33 @@ class Converter(object):
                 #         junction_list[road.junction]=list()
 
                 road.start_lway_id = way_id
+                lane_ways = self.lane_ways[road_id] = {'l': list(), 'r': list()}
                 pbar.set_description("Processing road_id=%s" % road_id)
                 offset = 0
                 next_lane=None
+                z_list = road.z_list()
                 for lane_i,lane_section in enumerate(road.lane_section_list):
                     offset = 0
                     if lane_i+1>=len(road.lane_section_list):
                         next_lane=None
                     else:
                         next_lane=road.lane_section_list[lane_i+1]
-                    point_to_width=dict()
-                    for lane in lane_section.left:
+                    start, stop = road.section_ranges[lane_i]
+                    lane_widths, lane_x, lane_y = lane_lines[lane_i][0]
+                    lane_widths, lane_x, lane_y = lane_widths.tolist(), lane_x.tolist(), lane_y.tolist()
+                    section_ways = list()
+                    lane_ways['l'].append(section_ways)
+                    for lane_j,lane in enumerate(lane_section.left):
                             way_nodes_id = list()
-                            for point in road.points:
-                                dis=point.s
-                                # if dis>1274:
-                                #     print("here")
-                                if lane_section.have_point(dis,next_lane):
-                                    width=lane.get_width(dis-lane_section.s)
-                                    offset=0
-                                    if point in point_to_width:
-                                        offset=point_to_width[point]
-                                    point_to_width[point]=width+offset
-                                    # width=0
-                                    if lane.type == "driving":
-                                        dx = cos(point.rad + pi / 2) * (offset+ (width / 2))
-                                        dy = sin(point.rad + pi / 2) * ( offset+ (width / 2))
-                                        new_node_id = self.add_node(point.x + dx, point.y + dy, point.z)
-                                        # print(new_node_id)
-                                        if not (new_node_id in way_nodes_id): # not exists in current way_nodes_id
-                                            way_nodes_id.append(new_node_id)
+                            for j,i in enumerate(range(start, stop)):
+                                width=lane_widths[lane_j][j]
+                                # width=0
+                                if lane.type == "driving":
+                                    new_node_id = self.add_sample_node(lane_x[lane_j][j], lane_y[lane_j][j], z_list[i])
+                                    # print(new_node_id)
+                                    way_nodes_id.append(new_node_id)
+                            # the repeated nodes are dropped once the lane is done, keeping the first ones
+                            way_nodes_id = unique_ids(way_nodes_id)
                             if len(way_nodes_id) > 0:
                                 ws_left, wd_left, n_left = lane_section.get_left_width()
                                 ws_right, wd_right, n_right = lane_section.get_right_width()
@@ -146,38 +177,35 @@ class Converter(object):
                                 way_nodes_id.reverse()
                                 self.ways[way_id] = Way(
                                     way_id, way_nodes_id, width, offset, road.is_connection, road.style, n_left, n_right, ws_left, ws_right)
+                                section_ways.append(way_id)
                                 way_id += 1
                                 # if way_id==8:
                                 #     print("here")
                     road.start_rway_id = way_id
                     offset = 0
-                    point_to_width=dict()
-                    for lane in lane_section.right:
+                    lane_widths, lane_x, lane_y = lane_lines[lane_i][1]
+                    lane_widths, lane_x, lane_y = lane_widths.tolist(), lane_x.tolist(), lane_y.tolist()
+                    section_ways = list()
+                    lane_ways['r'].append(section_ways)
+                    for lane_j,lane in enumerate(lane_section.right):
                         
                             way_nodes_id = list()
-                            for point in road.points:
-                                dis=point.s
-                                if lane_section.have_point(dis,next_lane):
-                                    width=lane.get_width(dis-lane_section.s)
-                                    offset=0
-                                    if point in point_to_width:
-                                        offset=point_to_width[point]
-                                    point_to_width[point]=width+offset
-                                    # width=0
-                                    # if abs(width-5.419095)<0.01:
-                                    #     continue
-                                    # if width<last_width:
-                                    #     #5.419095
-                                    last_width=width
-                                    if lane.type == "driving":
-                                        dx = cos(point.rad - pi / 2) * (offset+ (width / 2))
-                                        dy = sin(point.rad - pi / 2) * ( offset+(width / 2))
-                                        new_node_id = self.add_node(point.x + dx, point.y + dy, point.z)
-
-                                        # print(new_node_id)
-                                        if not (new_node_id in way_nodes_id): # not exists in current way_nodes_id
-                                            way_nodes_id.append(new_node_id)
-
+                            for j,i in enumerate(range(start, stop)):
+                                width=lane_widths[lane_j][j]
+                                # width=0
+                                # if abs(width-5.419095)<0.01:
+                                #     continue
+                                # if width<last_width:
+                                #     #5.419095
+                                last_width=width
+                                if lane.type == "driving":
+                                    new_node_id = self.add_sample_node(lane_x[lane_j][j], lane_y[lane_j][j], z_list[i])
+
+                                    # print(new_node_id)
+                                    way_nodes_id.append(new_node_id)
+
+                            # the repeated nodes are dropped once the lane is done, keeping the first ones
+                            way_nodes_id = unique_ids(way_nodes_id)
                             if len(way_nodes_id) > 0:
                                 ws_left, wd_left, n_left = lane_section.get_left_width()
                                 ws_right, wd_right, n_right = lane_section.get_right_width()
@@ -187,31 +215,124 @@ class Converter(object):
                                 offset = width
                                 self.ways[way_id] = Way(
                                     way_id, way_nodes_id, width, offset, road.is_connection, road.style, n_left, n_right, ws_left, ws_right)
+                                section_ways.append(way_id)
 
                             # offset += width
                                 way_id += 1
                                 # if way_id==8:
                                 #     print("here")
                 pbar.update(1)
+        if self.bulk_merge:
+            self.merge_nodes()
 
         # 2. handle the junctions: merge nodes & switch the end points of roads
-        # for junction in self.opendrive.junctions.values():
-        #     if len(junction.lane_link) >= 2:
-        #         is_Tshape_junction = False
-        #         is_Xshape_junction = False
-
-        #         if len(junction.lane_link) == 3:
-        #             is_Tshape_junction = self.handle_Tshape(junction)
-
-        #         if len(junction.lane_link) == 4:
-        #             is_Xshape_junction = True
-        #             self.handle_Xshape(junction)
-
-        #         if not is_Tshape_junction and not is_Xshape_junction:
-        #             self.handle_Nshape(junction)
+        # The ways are found in the lane_ways tables, each junction is resolved
+        # from its links, in a time linear in its connections and lanes
+        if self.junctions:
+            for junction in self.opendrive.junctions.values():
+                self.handle_junction(junction)
+            self.drop_unused_nodes()
 
         # return ways, nodes
 
+    def handle_junction(self, junction):
+        # the first connection of each incoming road
+        links = [self.junction_link(junction, incoming_road) for incoming_road, _, _ in junction.lane_link]
+        if len(links) < 2:
+            return
+        # no lane end is farther from the junction than its longest connecting road
+        self.junction_reach = max(float(self.opendrive.roads[connection.connecting_road].length)
+                                  for connection in junction.connections)
+        is_Tshape_junction = False
+        is_Xshape_junction = False
+
+        if len(links) == 3:
+            # the incoming roads going straight through the junction make the
+            # line 1-2 of the T, the other ones its branch
+            straight = dict()
+            for connection in junction.connections:
+                if connection.incoming_road not in straight and \
+                        self.opendrive.roads[connection.connecting_road].style == 'line':
+                    straight[connection.incoming_road] = self.junction_link(junction, connection.incoming_road)
+            branches = [link for (incoming_road, _, _), link in zip(junction.lane_link, links)
+                        if incoming_road not in straight]
+            is_Tshape_junction = self.handle_Tshape(junction, list(straight.values()), branches)
+
+        if len(links) == 4:
+            is_Xshape_junction = True
+            self.handle_Xshape(junction, links)
+
+        if not is_Tshape_junction and not is_Xshape_junction:
+            self.handle_Nshape(junction, links)
+
+    # The lanes of an incoming road at the junction, per side: the ways of its
+    # driving lanes at the junction, from the centre line out, with their end
+    # (0/-1) there. The nodes of the right ways go along the road, the ones of
+    # the left ways backwards
+    def junction_link(self, junction, incoming_road):
+        successor = self.opendrive.roads[incoming_road].successor
+        at_end = successor is not None and successor.element_type == 'junction' and successor.element_id == junction.id
+        link = dict()
+        for side in ('l', 'r'):
+            sections = self.lane_ways[incoming_road][side]
+            ways = sections[-1 if at_end else 0] if sections else []
+            way_end = -1 if at_end == (side == 'r') else 0
+            link[side] = [(way_id, way_end) for way_id in ways]
+        return link
+
+    # The lanes roadcnt of the links on a side, as (incoming way, end of the
+    # incoming way at the junction), the links with fewer lanes are left out
+    def junction_lanes(self, links, side, roadcnt):
+        return [link[side][roadcnt] for link in links if roadcnt < len(link[side])]
+
+    # The end node of the way at the junction, and the node before it (the
+    # same one for a way of a single node)
+    def way_end_nodes(self, incoming_way, way_end):
+        nodes_id = self.ways[incoming_way].nodes_id
+        before = way_end if len(nodes_id) < 2 else way_end + 1 if way_end == 0 else way_end - 1
+        return self.nodes[nodes_id[way_end]], self.nodes[nodes_id[before]]
+
+    # The cross point of the lines of the lane ends, unless they are nearly
+    # parallel and it is farther than the reach of the junction from all the
+    # ends, the mean of the ends is used then
+    def junction_point(self, cross_point, nodes):
+        if min(point_distance(cross_point, node) for node in nodes) <= self.junction_reach:
+            return cross_point
+        return Point(sum(node.x for node in nodes) / len(nodes), sum(node.y for node in nodes) / len(nodes))
+
+    # Moves the end (0/-1) of the way to the node. When the node is already the
+    # one next to the end, the end is dropped instead of repeating the node,
+    # unless the way would be left with a single node, it keeps its end then
+    def set_way_end(self, way_id, way_end, node_id):
+        nodes_id = self.ways[way_id].nodes_id
+        if len(nodes_id) >= 2 and nodes_id[1 if way_end == 0 else -2] == node_id:
+            if len(nodes_id) > 2:
+                del nodes_id[way_end]
+        else:
+            nodes_id[way_end] = node_id
+
+    # The nodes no way references any more, the lane ends replaced by the
+    # junction points, are dropped and the other ones numbered again in order
+    def drop_unused_nodes(self):
+        used = set()
+        for way in self.ways.values():
+            used.update(way.nodes_id)
+        if len(used) == len(self.nodes):
+            return
+        new_ids = dict()
+        nodes = list()
+        self.spindex = GridIndex(2 * self.min_distance)
+        for node in self.nodes:
+            if node.id in used:
+                new_ids[node.id] = node.id = len(nodes)
+                nodes.append(node)
+                self.spindex.insert(
+                    node.id, (node.x-self.min_distance, node.y-self.min_distance, node.x+self.min_distance, node.y+self.min_distance))
+        self.nodes = nodes
+        self.node_id = len(nodes)
+        for way in self.ways.values():
+            way.nodes_id = [new_ids[node_id] for node_id in way.nodes_id]
+
     def way_end_to_point(self, node_id, way_id):
         # find the closer end (0/-1) of the way to the node
         distance_to_start = point_distance(
@@ -225,7 +346,7 @@ class Converter(object):
             return -1
 
 
-    def handle_Tshape(self, junction):
+    def handle_Tshape(self, junction, straight, branches):
         # A T shape junction would be like:
         # ----1---*---2----
         #         |
@@ -241,146 +362,70 @@ class Converter(object):
         is_Tshape_junction = False
 
         roadcnt = 0
-        while (self.handle_Tshape_singleway(junction, 'l', roadcnt)):
+        while (self.handle_Tshape_singleway(junction, straight, branches, 'l', roadcnt)):
             is_Tshape_junction = True
             roadcnt += 1
 
         roadcnt = 0
-        while (self.handle_Tshape_singleway(junction, 'r', roadcnt)):
+        while (self.handle_Tshape_singleway(junction, straight, branches, 'r', roadcnt)):
             is_Tshape_junction = True
             roadcnt += 1
 
         return is_Tshape_junction
 
-    def handle_Tshape_singleway(self, junction, side, roadcnt):
-        # A T shape junction would be like:
-        # ----1---*---2----
-        #         |
-        #         |
-        #         3
-        #         4
-        #         |
-        #         |
-        #
-        # we need to get the * point
-        # so we use four points to interpolate
-        is_Tshape_junction = False
-        ret = 0
+    def handle_Tshape_singleway(self, junction, straight, branches, side, roadcnt):
+        # 1. add the contact point (1,2) of a T junction
+        lanes = self.junction_lanes(straight, side, roadcnt)
+        branch_lanes = self.junction_lanes(branches, side, roadcnt)
+        if len(lanes) < 2 or not branch_lanes:
+            return False
+        line1_nodes = [self.nodes[self.ways[incoming_way].nodes_id[way_end]] for incoming_way, way_end in lanes]
 
-        lane_link = junction.lane_link
-        line1_nodes = list()
-        incomings = list()
-        ends = list()
+        # 2. add the contact point (3,4) of a T junction
+        line2_nodes = list()
+        for incoming_way, way_end in branch_lanes:
+            line2_nodes.extend(self.way_end_nodes(incoming_way, way_end))
+        lanes.extend(branch_lanes)
 
-        for connection in junction.connections:
-            contact_point = connection.contact_point
-            incoming_road = connection.incoming_road
-            connecting_road = connection.connecting_road
-            
+        # calculate the cross point of line(1,2) and line(3,4)
+        cross_point = self.junction_point(line_cross(line1_nodes, line2_nodes), line1_nodes + line2_nodes)
+        cross_point.z = (line1_nodes[0].z + line1_nodes[1].z + line2_nodes[0].z + line2_nodes[1].z) /4
 
-            # 1. add the contact point (1,2) of a T junction
-            if self.ways[self.opendrive.roads[connecting_road].start_lway_id].style == 'line':
-                inn = self.opendrive.roads[incoming_road].ln if side=='l' else self.opendrive.roads[incoming_road].rn
-                con = self.opendrive.roads[connecting_road].ln if side=='l' else self.opendrive.roads[connecting_road].rn
-                min = inn if inn < con else con
-                if (roadcnt >= min):
-                    continue
-                ret += 1
-                connecting_way = self.opendrive.roads[connecting_road].start_lway_id + roadcnt if side=='l' else self.opendrive.roads[connecting_road].start_rway_id + roadcnt
-                incoming_way = self.opendrive.roads[incoming_road].start_lway_id + roadcnt if side=='l' else self.opendrive.roads[incoming_road].start_rway_id + roadcnt
-                contact_node_id = self.ways[connecting_way].nodes_id[0 if contact_point == 'start' else -1]
-                way_end = self.way_end_to_point(contact_node_id, incoming_way)
-                line1_nodes.append(
-                    self.nodes[self.ways[incoming_way].nodes_id[way_end]])
-                    
-                incomings.append(incoming_way)
-                ends.append(way_end)
-                
-                # search and delete the incoming road in lane_link we just used
-                for i in range(len(lane_link)):
-                    if lane_link[i][0] == incoming_road:
-                        del lane_link[i]
-                        break
-
-        if (ret <= 0):
-            return ret
-        line2_nodes = list()
-        if len(line1_nodes) >= 2:
-            is_Tshape_junction = True
+        line1_nodes.extend(line2_nodes)
+        self.min_distance_to_center = min(point_distance(
+            cross_point, p) for p in line1_nodes)
 
-            # 2. add the contact point (3,4) of a T junction
-            for incoming_road, connecting_road, contact_point in lane_link:
-                
-                connecting_way = self.opendrive.roads[connecting_road].start_lway_id + roadcnt if side=='l' else self.opendrive.roads[connecting_road].start_rway_id + roadcnt
-                incoming_way = self.opendrive.roads[incoming_road].start_lway_id + roadcnt if side=='l' else self.opendrive.roads[incoming_road].start_rway_id + roadcnt
-                contact_node_id = self.ways[connecting_way].nodes_id[0 if contact_point == 'start' else -1]
-                way_end = self.way_end_to_point(contact_node_id, incoming_way)
-
-                line2_nodes.append(
-                    self.nodes[self.ways[incoming_way].nodes_id[way_end]])
-                line2_nodes.append(
-                    self.nodes[self.ways[incoming_way].nodes_id[(way_end + 1 if way_end == 0 else way_end - 1)]])
-                incomings.append(incoming_way)
-                ends.append(way_end)
-
-            # calculate the cross point of line(1,2) and line(3,4)
-            cross_point = line_cross(line1_nodes, line2_nodes)
-            cross_point.z = (line1_nodes[0].z + line1_nodes[1].z + line2_nodes[0].z + line2_nodes[1].z) /4
-
-            line1_nodes.extend(line2_nodes)
-            self.min_distance_to_center = min(point_distance(
-                cross_point, p) for p in line1_nodes)
-        
-            new_node_id = self.add_node(cross_point.x, cross_point.y, cross_point.z, min([junction.max_arcrad, self.min_distance_to_center]))
-            
-            for incoming_way, way_end in zip(incomings, ends):
-                self.ways[incoming_way].nodes_id[way_end] = new_node_id
+        new_node_id = self.add_node(cross_point.x, cross_point.y, cross_point.z, min([junction.max_arcrad, self.min_distance_to_center]))
 
-        return is_Tshape_junction
+        for incoming_way, way_end in lanes:
+            self.set_way_end(incoming_way, way_end, new_node_id)
+
+        return True
 
 
-    def handle_Xshape(self, junction):
+    def handle_Xshape(self, junction, links):
 
         roadcnt = 0
-        while (self.handle_Xshape_singleway(junction, 'l', roadcnt)):
+        while (self.handle_Xshape_singleway(junction, links, 'l', roadcnt)):
             roadcnt += 1
 
         roadcnt = 0
-        while (self.handle_Xshape_singleway(junction, 'r', roadcnt)):
+        while (self.handle_Xshape_singleway(junction, links, 'r', roadcnt)):
             roadcnt += 1
 
-    
-    def handle_Xshape_singleway(self, junction, side, roadcnt):
-
-        line_nodes = list()
-        incomings = list()
-        ends = list()
-        ret = 0
-        for incoming_road, connecting_road, contact_point in junction.lane_link:
-            inn = self.opendrive.roads[incoming_road].ln if side=='l' else self.opendrive.roads[incoming_road].rn
-            con = self.opendrive.roads[connecting_road].ln if side=='l' else self.opendrive.roads[connecting_road].rn
-            min = inn if inn < con else con
-            if (roadcnt >= min):
-                continue
-
-            ret += 1
-            connecting_way = self.opendrive.roads[connecting_road].start_lway_id + roadcnt if side=='l' else self.opendrive.roads[connecting_road].start_rway_id + roadcnt
-            incoming_way = self.opendrive.roads[incoming_road].start_lway_id + roadcnt if side=='l' else self.opendrive.roads[incoming_road].start_rway_id + roadcnt
-            contact_node_id = self.ways[connecting_way].nodes_id[0 if contact_point == 'start' else -1]
-            way_end = self.way_end_to_point(contact_node_id, incoming_way)
-            line_nodes.append(
-                self.nodes[self.ways[incoming_way].nodes_id[way_end]])
-            incomings.append(incoming_way)
-            ends.append(way_end)
-            # self.ways[incoming_road].nodes_id[way_end] = self.node_id
-
-        if (ret <= 3):
+
+    def handle_Xshape_singleway(self, junction, links, side, roadcnt):
+
+        lanes = self.junction_lanes(links, side, roadcnt)
+        if (len(lanes) <= 3):
             return 0
+        line_nodes = [self.nodes[self.ways[incoming_way].nodes_id[way_end]] for incoming_way, way_end in lanes]
+
         diag_node_index = find_diagonal(line_nodes)
         if diag_node_index != 1:  # we fix 0,1 as diagonal pair
             line_nodes[1], line_nodes[diag_node_index] = line_nodes[diag_node_index], line_nodes[1]
 
-        cross_point = line_cross(line_nodes[:2], line_nodes[2:])
+        cross_point = self.junction_point(line_cross(line_nodes[:2], line_nodes[2:]), line_nodes)
         cross_point.z = (line_nodes[0].z + line_nodes[1].z + line_nodes[2].z + line_nodes[3].z) /4
 
         self.min_distance_to_center = min(point_distance(
@@ -388,104 +433,87 @@ class Converter(object):
         # print(self.min_distance_to_center, junction.max_arcrad)
 
         new_node_id = self.add_node(cross_point.x, cross_point.y, cross_point.z, min([junction.max_arcrad, self.min_distance_to_center]))
-        
-        for incoming_way, way_end in zip(incomings, ends):
-            self.ways[incoming_way].nodes_id[way_end] = new_node_id
 
-        return ret
+        for incoming_way, way_end in lanes:
+            self.set_way_end(incoming_way, way_end, new_node_id)
 
-    def handle_Nshape(self, junction):
+        return len(lanes)
+
+    def handle_Nshape(self, junction, links):
         roadcnt = 0
-        while (self.handle_Nshape_singleway(junction, 'l', roadcnt)):
+        while (self.handle_Nshape_singleway(junction, links, 'l', roadcnt)):
             roadcnt += 1
 
         roadcnt = 0
-        while (self.handle_Nshape_singleway(junction, 'r', roadcnt)):
+        while (self.handle_Nshape_singleway(junction, links, 'r', roadcnt)):
             roadcnt += 1
 
-    
-    def handle_Nshape_singleway(self, junction, side, roadcnt):
-        
-        line1_nodes = list()
-        line2_nodes = list()
-        ret = 0
 
-        last_node_id = None
+    def handle_Nshape_singleway(self, junction, links, side, roadcnt):
 
         # add the contact point of an incoming road as line1
-        incoming_road, connecting_road, contact_point = junction.lane_link[0]
-        inn = self.opendrive.roads[incoming_road].ln if side=='l' else self.opendrive.roads[incoming_road].rn
-        con = self.opendrive.roads[connecting_road].ln if side=='l' else self.opendrive.roads[connecting_road].rn
-        min = inn if inn < con else con
-        if (roadcnt >= min):
+        first_lanes = self.junction_lanes(links[:1], side, roadcnt)
+        if not first_lanes:
             return 0
-        
-        ret += 1
-        connecting_way = self.opendrive.roads[connecting_road].start_lway_id + roadcnt if side=='l' else self.opendrive.roads[connecting_road].start_rway_id + roadcnt
-        incoming_way = self.opendrive.roads[incoming_road].start_lway_id + roadcnt if side=='l' else self.opendrive.roads[incoming_road].start_rway_id + roadcnt
-        
-        contact_node_id = self.ways[connecting_way].nodes_id[0 if contact_point == 'start' else -1]
-        way_end = self.way_end_to_point(contact_node_id, incoming_way)
-
-        line1_nodes.append(
-            self.nodes[self.ways[incoming_way].nodes_id[way_end]])
-        line1_nodes.append(
-            self.nodes[self.ways[incoming_way].nodes_id[(way_end + 1 if way_end == 0 else way_end - 1)]])
-        # self.ways[incoming_road].nodes_id[way_end] = self.node_id
-        first_incoming = incoming_way
-        first_end = way_end
+        first_incoming, first_end = first_lanes[0]
+        line1_nodes = list(self.way_end_nodes(first_incoming, first_end))
 
+        last_node_id = None
+        lanes = self.junction_lanes(links[1:], side, roadcnt)
 
         # add the contact point of an incoming road as line2
-        for incoming_road, connecting_road, contact_point in junction.lane_link[1:]:
-            inn = self.opendrive.roads[incoming_road].ln if side=='l' else self.opendrive.roads[incoming_road].rn
-            con = self.opendrive.roads[connecting_road].ln if side=='l' else self.opendrive.roads[connecting_road].rn
-            min = inn if inn < con else con
-            if (roadcnt >= min):
-                continue
-            ret += 1
-            connecting_way = self.opendrive.roads[connecting_road].start_lway_id + roadcnt if side=='l' else self.opendrive.roads[connecting_road].start_rway_id + roadcnt
-            incoming_way = self.opendrive.roads[incoming_road].start_lway_id + roadcnt if side=='l' else self.opendrive.roads[incoming_road].start_rway_id + roadcnt
-            contact_node_id = self.ways[connecting_way].nodes_id[0 if contact_point == 'start' else -1]
-            way_end = self.way_end_to_point(contact_node_id, incoming_way)
-
-            line2_nodes.append(
-                self.nodes[self.ways[incoming_way].nodes_id[way_end]])
-            
-            line2_nodes.append(
-                self.nodes[self.ways[incoming_way].nodes_id[(way_end + 1 if way_end == 0 else way_end - 1)]])
+        for incoming_way, way_end in lanes:
+            line2_nodes = list(self.way_end_nodes(incoming_way, way_end))
 
             # calculate the cross point of line1 and line2
-            cross_point = line_cross(line1_nodes, line2_nodes)
+            cross_point = self.junction_point(line_cross(line1_nodes, line2_nodes), line1_nodes + line2_nodes)
             line1_nodes = line2_nodes
-            line2_nodes = []
-            # print(self.node_id)
 
             if last_node_id is not None:
                 if point_distance(self.nodes[last_node_id], cross_point) > self.min_distance * 10:
                     # connect incoming road to the new cross point
                     # and insert new cross point into last road
                     new_node_id = self.add_node(cross_point.x, cross_point.y, 0, 5)
-                    self.ways[incoming_way].nodes_id[way_end] = new_node_id
+                    self.set_way_end(incoming_way, way_end, new_node_id)
                     last_node_id = new_node_id
 
                     self.insert_node(last_incoming, new_node_id, last_end )
-                    
+
                 else: # connect incoming road to last cross point
-                    self.ways[incoming_way].nodes_id[way_end] = last_node_id
+                    self.set_way_end(incoming_way, way_end, last_node_id)
 
             else:
                 new_node_id = self.add_node(cross_point.x, cross_point.y, 0, 5)
-                self.ways[incoming_way].nodes_id[way_end] = new_node_id
-                self.ways[first_incoming].nodes_id[first_end] = new_node_id
+                self.set_way_end(incoming_way, way_end, new_node_id)
+                self.set_way_end(first_incoming, first_end, new_node_id)
                 last_node_id = new_node_id
 
             last_incoming = incoming_way
             last_end = way_end
 
-        return ret
+        return 1 + len(lanes)
+
 
 
+    def add_sample_node(self, x, y, z):
+        # with bulk merge the samples are only collected, merge_nodes turns them into nodes
+        if not self.bulk_merge:
+            return self.add_node(x, y, z)
+        self.samples.append((x, y, z))
+        return len(self.samples) - 1
+
+    def merge_nodes(self):
+        labels, representatives = merge_points(self.samples, self.min_distance)
+        # each group becomes a node, at its representative sample
+        start_id = self.node_id
+        for sample_id in representatives:
+            x, y, z = self.samples[sample_id]
+            self.nodes.append(Node(self.node_id, x, y, z))
+            self.spindex.insert(
+                self.node_id, (x-self.min_distance, y-self.min_distance, x+self.min_distance, y+self.min_distance))
+            self.node_id = self.node_id + 1
+        remap_ways(self.ways, [start_id + label for label in labels])
+        self.samples = list()
 
     def add_node(self, x, y, z, arc=0):
         # search for dup
@@ -520,10 +548,9 @@ class Converter(object):
             else:
                 self.ways[way_id].nodes_id.append(node_id)
 
-    def generate_osm(self, filename, debug = False):
+    def generate_osm(self, filename, debug = False, format = 'osm'):
         # plt.axis('scaled')
-        wgs84_to_utm =Proj(proj='utm',zone=50,ellps='WGS84')
-        base_utmx,base_utmy=wgs84_to_utm(self.opendrive.lon,self.opendrive.lat)
+        projection = self.opendrive.projection()
         if debug:
            
            
@@ -546,61 +573,52 @@ class Converter(object):
             plt.show()
         osm_attrib = {'version': "0.6", 'generator': "xodr_OSM_converter", 'copyright': "Simon",
                       'attribution': "Simon", 'license': "GNU or whatever"}
-        osm_root = ET.Element('osm', osm_attrib)
-
         bounds_attrib = {'minlat': '0', 'minlon': '0',
                          'maxlat': '1', 'maxlon': '1'}
-        ET.SubElement(osm_root, 'bounds', bounds_attrib)
+        timestamp = datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        # all the nodes are projected at once
+        node_x = np.array([node.x for node in self.nodes])
+        node_y = np.array([node.y for node in self.nodes])
+        lon_list, lat_list = projection.lonlat(node_x, node_y)
+        lon_list, lat_list = np.asarray(lon_list).tolist(), np.asarray(lat_list).tolist()
+
+        # the elements are written as they are made, the document is never in memory
+        # pbf takes the same elements as the XML
+        writer_class = PBFWriter if format == 'pbf' else OSMWriter
+        with writer_class(filename) as writer:
+            writer.start('osm', osm_attrib)
+            writer.empty('bounds', bounds_attrib)
+
+            # add all nodes into osm
+            for node, lon, lat in zip(self.nodes, lon_list, lat_list):
+                writer.node(node.id+1, lon, lat, timestamp, [
+                    ("type", 'Smart'),
+                    ("height", node.z),
+                    ("minArcRadius", node.max_arcrad)])
+
+            for index, way_id in enumerate(self.ways):
+                # if way_id!=95 or way_id!=86:
+                #     continue
+                way_value = self.ways[way_id]
+                # if way_value.is_connecting:  # ignore all connecting roads
+                #     continue
 
-        # add all nodes into osm
-        for node in self.nodes:
-            node_x,node_y= wgs84_to_utm(base_utmx+node.x,base_utmy+node.y,inverse=True)
-            node_attrib = {'id': str(node.id+1), 'visible': 'true', 'version': '1', 'changeset': '1', 'timestamp': datetime.utcnow().strftime(
-                '%Y-%m-%dT%H:%M:%SZ'), 'user': 'simon', 'uid': '1', 'lon': str(node_x ), 'lat': str(node_y), 'ele':'2'}
-            node_root = ET.SubElement(osm_root, 'node', node_attrib)
-
-            ET.SubElement(node_root, 'tag', {'k': "type", 'v': 'Smart'})
-            ET.SubElement(node_root, 'tag', {'k': "height", 'v': str(node.z)})
-            ET.SubElement(node_root, 'tag', {
-                          'k': "minArcRadius", 'v': str(node.max_arcrad)})
-
-        for index, way_id in enumerate(self.ways):
-            # if way_id!=95 or way_id!=86:
-            #     continue
-            way_value = self.ways[way_id]
-            # if way_value.is_connecting:  # ignore all connecting roads
-            #     continue
-
-            way_attrib = {'id': str(index+1), 'version': '1', 'changeset': '1',
-                          'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'), 'user': 'simon', 'uid': '1'}
-            way_root = ET.SubElement(osm_root, 'way', way_attrib)
-
-            # add all nodes of a road
-            for way_node in way_value.nodes_id:
-                ET.SubElement(way_root, 'nd', {'ref': str(way_node+1)})
-
-            # ET.SubElement(way_root, 'tag', {'k': "highway", 'v':'tertiary'})
-            ET.SubElement(way_root, 'tag', {
-                          'k': "name", 'v': 'road'+str(way_value.id)})
-            ET.SubElement(way_root, 'tag', {
-                          'k': "streetWidth", 'v': str(way_value.width)})
-            ET.SubElement(way_root, 'tag', {
-                          'k': "streetOffset", 'v': str(way_value.offset)})
-            ET.SubElement(way_root, 'tag', {
-                          'k': "sidewalkWidthLeft", 'v': str(way_value.widthleftwalk)})
-            ET.SubElement(way_root, 'tag', {
-                          'k': "sidewalkWidthRight", 'v': str(way_value.widthrightwalk)})
-            ET.SubElement(way_root, 'tag', {
-                          'k': "NbrOfRightLanes", 'v': str(way_value.nrightlanes)})
-
-            ET.SubElement(way_root, 'tag', {
-                          'k': "nLanesTotal", 'v': str(way_value.nrightlanes + way_value.nleftlanes)})
-            if way_value.nrightlanes == 0 or way_value.nleftlanes == 0:
-                ET.SubElement(way_root, 'tag', {
-                    'k': "Centerline", 'v': "none"})
-
-        tree = ET.ElementTree(osm_root)
-        tree.write(filename)
+                # tags.append(("highway", 'tertiary'))
+                tags = [("name", 'road'+str(way_value.id)),
+                        ("streetWidth", way_value.width),
+                        ("streetOffset", way_value.offset),
+                        ("sidewalkWidthLeft", way_value.widthleftwalk),
+                        ("sidewalkWidthRight", way_value.widthrightwalk),
+                        ("NbrOfRightLanes", way_value.nrightlanes),
+                        ("nLanesTotal", way_value.nrightlanes + way_value.nleftlanes)]
+                if way_value.nrightlanes == 0 or way_value.nleftlanes == 0:
+                    tags.append(("Centerline", "none"))
+
+                # add all nodes of a road
+                writer.way(index+1, [way_node+1 for way_node in way_value.nodes_id], timestamp, tags)
+
+            writer.end('osm')
 
 
 RESOURCE_PATH = "../resource/"
@@ -610,14 +628,28 @@ if __name__ == '__main__':
     parser.add_argument('--debug', type=bool, default=False, help='Is using debug mode')
     parser.add_argument('--input_file', type=str, default='testfield_no_roundabout.xodr', help='Input OpenDRIVE file name')
     parser.add_argument('--scale', type=int, default=10000, help='Scale of xodr file (in meter)')
-    parser.add_argument('--precise', type=int, default=0.1, help='Precision of OSM file (in meter)')
+    parser.add_argument('--precise', type=float, default=0.1, help='Precision of OSM file (in meter)')
     parser.add_argument('--output_file', type=str, default='example.osm', help='Output OSM file name')
+    parser.add_argument('--stream', action='store_true', help='Parse the OpenDRIVE file with iterparse instead of loading the whole DOM')
+    parser.add_argument('--adaptive', action='store_true', help='Sample the roads adaptively, with a chord error up to --precise, instead of every meter')
+    parser.add_argument('--bulk_merge', action='store_true', help='Merge the nodes closer than --precise in one KD-tree pass after sampling all the roads')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes sampling the roads and computing their lane centre lines')
+    parser.add_argument('--format', type=str, default='osm', choices=['osm', 'pbf'], help='Format of the output file, OSM XML or OSM PBF')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory of the cache of the built OpenDRIVE models, no cache by default')
+    parser.add_argument('--cache_size', type=int, default=1024, help='Size of the model cache (in MB), the least recently used models are removed beyond it')
+    parser.add_argument('--incremental', action='store_true', help='Reuse the roads, junctions and lane centre lines of the <road> and <junction> elements unchanged since the last conversion of the file (needs --cache_dir)')
+    parser.add_argument('--junctions', action='store_true', help='Merge the ends of the lanes meeting in the junctions in a single node')
     args = parser.parse_args()
+    if args.incremental and not args.cache_dir:
+        parser.error('--incremental needs --cache_dir')
     print(args)
 
     print('Start converting file...')
 
-    converter = Converter(RESOURCE_PATH + args.input_file, args.scale, args.precise)
-    converter.generate_osm(RESOURCE_PATH + args.output_file, args.debug)
+    cache = ModelCache(args.cache_dir, args.cache_size * 1024 * 1024, args.incremental) if args.cache_dir else None
+
+    converter = Converter(RESOURCE_PATH + args.input_file, args.scale, args.precise, args.stream, args.adaptive, args.bulk_merge, args.workers, cache=cache,
+                          junctions=args.junctions)
+    converter.generate_osm(RESOURCE_PATH + args.output_file, args.debug, args.format)
 
     print('All done')
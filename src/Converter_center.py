@@ -3,11 +3,14 @@ import xml.etree.ElementTree as ET
 from math import fabs, sqrt, sin, cos, pi
 import matplotlib.pyplot as plt
 from datetime import datetime
+import numpy as np
 
-from opendrivepy.opendrive import OpenDrive
+from opendrivepy.cache import ModelCache, load_opendrive
 from opendrivepy.point import Point
 from tqdm import tqdm
-from pyqtree import Index
+from GridIndex import GridIndex
+from NodeMerge import merge_points, remap_ways
+from RoadWorkers import sample_roads
 
 from OSMtype import *
 from Utils import *
@@ -24,13 +27,27 @@ MAX_ARC_RADIUS = 50
 class Converter(object):
     """docstring for Converter"""
 
-    def __init__(self, filename, scene_scale, min_distance):
+    def __init__(self, filename, scene_scale, min_distance, stream=False, adaptive=False, bulk_merge=False, opendrive=None,
+                 cache=None, workers=1):
         super(Converter, self).__init__()
 
-        print("Reading OpenDrive file: " + filename)
-        self.opendrive = OpenDrive(filename)
+        # adaptive sampling keeps the sampled lanes within min_distance of the real ones
+        # the map can be shared with the other converters, or come from the cache (a ModelCache)
+        self.filename = filename
+        self.stream = stream
+        self.max_error = min_distance if adaptive else None
+        self.cache = cache
+        if opendrive is None:
+            print("Reading OpenDrive file: " + filename)
+            opendrive = load_opendrive(filename, stream, self.max_error, cache)
+        self.opendrive = opendrive
         self.scale, minx, miny, maxx, maxy = self.set_scale(scene_scale)
         self.min_distance = min_distance
+        # merge the road samples in one pass after the roads instead of one by one
+        self.bulk_merge = bulk_merge
+        self.samples = list()
+        # processes sampling the roads
+        self.workers = workers
         # print(self.scale)
 
         print("Converting...")
@@ -38,7 +55,8 @@ class Converter(object):
         self.ways = dict()
         self.nodes = list()
 
-        self.spindex = Index(bbox=(minx, miny, maxx, maxy))
+        # the nodes are boxes of +-min_distance around them
+        self.spindex = GridIndex(2 * self.min_distance)
         self.convert()
 
     def set_scale(self, scene_scale):
@@ -68,6 +86,8 @@ class Converter(object):
 
     def convert(self):
         # 1. convert all roads into nodes+ways
+        # the roads are sampled in worker processes first, when there are some
+        sample_roads(self.opendrive, self.workers, self.filename, self.stream, self.max_error, self.cache)
         way_id = 0
         with tqdm(total=len(self.opendrive.roads), ascii=True) as pbar:
             for road_id, road in self.opendrive.roads.items():
@@ -75,11 +95,13 @@ class Converter(object):
                 way_nodes_id = list()
 
                 # all points in a road
-                for point in road.points:
-                    new_node_id = self.add_node(point.x, point.y, point.z)
+                for x, y, z in zip(road.x_array.tolist(), road.y_array.tolist(), road.z_list()):
+                    new_node_id = self.add_sample_node(x, y, z)
                     # print(new_node_id)
-                    if not (new_node_id in way_nodes_id): # not exists in current way_nodes_id
-                        way_nodes_id.append(new_node_id)                    
+                    way_nodes_id.append(new_node_id)
+
+                # the repeated nodes are dropped once the road is done, keeping the first ones
+                way_nodes_id = unique_ids(way_nodes_id)
 
                 # set the width of ways
                 if len(way_nodes_id) > 0:
@@ -91,6 +113,8 @@ class Converter(object):
                     self.ways[road_id] = Way(
                         road_id, way_nodes_id, width, offset, road.is_connection, road.style, n_left, n_right, ws_left, ws_right)
                 pbar.update(1)
+        if self.bulk_merge:
+            self.merge_nodes()
 
 
     def way_end_to_point(self, node_id, way_id):
@@ -368,6 +392,26 @@ class Converter(object):
 
 
 
+    def add_sample_node(self, x, y, z):
+        # with bulk merge the samples are only collected, merge_nodes turns them into nodes
+        if not self.bulk_merge:
+            return self.add_node(x, y, z)
+        self.samples.append((x, y, z))
+        return len(self.samples) - 1
+
+    def merge_nodes(self):
+        labels, representatives = merge_points(self.samples, self.min_distance)
+        # each group becomes a node, at its representative sample
+        start_id = self.node_id
+        for sample_id in representatives:
+            x, y, z = self.samples[sample_id]
+            self.nodes.append(Node(self.node_id, x, y, z))
+            self.spindex.insert(
+                self.node_id, (x-self.min_distance, y-self.min_distance, x+self.min_distance, y+self.min_distance))
+            self.node_id = self.node_id + 1
+        remap_ways(self.ways, [start_id + label for label in labels])
+        self.samples = list()
+
     def add_node(self, x, y, z, arc=0):
         # search for dup
         near_node_ids = self.spindex.intersect((x, y, x, y))
@@ -403,17 +447,20 @@ class Converter(object):
 
     def generate_osm(self, filename, debug = False):
         # plt.axis('scaled')
-        wgs84_to_utm =Proj(proj='utm',zone=51,ellps='WGS84')
-        base_utmx,base_utmy=wgs84_to_utm(self.opendrive.lon,self.opendrive.lat)
+        projection = self.opendrive.projection()
+        # all the nodes are projected at once
+        node_x = np.array([node.x for node in self.nodes])
+        node_y = np.array([node.y for node in self.nodes])
+        lon_list, lat_list = (np.asarray(c).tolist() for c in projection.lonlat(node_x, node_y))
+        utmx_list, utmy_list = (np.asarray(c).tolist() for c in projection.utm_xy(node_x, node_y))
         csvfile = open(filename+"_main.csv", 'w')
         writer = csv.writer(csvfile)
         writer.writerow(['road_id', 'lon', 'lat','utmX','utmY','heading','mode','speed_mode','event_mode','oppsite_side_mode','lane_num','lane_seq','lane_width'])
         data = [ ]
         if debug:
             for node in self.nodes:
-                utmx,utmy=base_utmx+node.x,base_utmy+node.y
-                node_x,node_y= wgs84_to_utm(utmx,utmy,inverse=True)
-                data.append((node.road_id,node_x,node_y,utmx,utmy,node.heading,0,3,0,0,node.lane_num,node.lane_seq,node.lane_width))
+                data.append((node.road_id,lon_list[node.id],lat_list[node.id],utmx_list[node.id],utmy_list[node.id],
+                             node.heading,0,3,0,0,node.lane_num,node.lane_seq,node.lane_width))
                 plt.plot(node.x, node.y, node.color)
             plt.show()
         csvfile.close()
@@ -427,9 +474,7 @@ class Converter(object):
             for way_node in way_value.nodes_id:
                 node=self.nodes[way_node]
                 # if not node.is_mid:
-                utmx,utmy=base_utmx+node.x,base_utmy+node.y
-                node_x,node_y= wgs84_to_utm(utmx,utmy,inverse=True)
-                data.append((node.road_id,node.lane_seq,node_x,node_y,utmx,utmy))
+                data.append((node.road_id,node.lane_seq,lon_list[way_node],lat_list[way_node],utmx_list[way_node],utmy_list[way_node]))
         writer.writerows(data)
         csvfile.close()
         return 
@@ -554,14 +599,26 @@ if __name__ == '__main__':
     parser.add_argument('--debug', type=bool, default=True, help='Is using debug mode')
     parser.add_argument('--input_file', type=str, default='new_undermap.xodr', help='Input OpenDRIVE file name')
     parser.add_argument('--scale', type=int, default=10000, help='Scale of xodr file (in meter)')
-    parser.add_argument('--precise', type=int, default=0.1, help='Precision of OSM file (in meter)')
+    parser.add_argument('--precise', type=float, default=0.1, help='Precision of OSM file (in meter)')
     parser.add_argument('--output_file', type=str, default='example.osm', help='Output OSM file name')
+    parser.add_argument('--stream', action='store_true', help='Parse the OpenDRIVE file with iterparse instead of loading the whole DOM')
+    parser.add_argument('--adaptive', action='store_true', help='Sample the roads adaptively, with a chord error up to --precise, instead of every meter')
+    parser.add_argument('--bulk_merge', action='store_true', help='Merge the nodes closer than --precise in one KD-tree pass after sampling all the roads')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes sampling the roads')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory of the cache of the built OpenDRIVE models, no cache by default')
+    parser.add_argument('--cache_size', type=int, default=1024, help='Size of the model cache (in MB), the least recently used models are removed beyond it')
+    parser.add_argument('--incremental', action='store_true', help='Reuse the roads, junctions and lane centre lines of the <road> and <junction> elements unchanged since the last conversion of the file (needs --cache_dir)')
     args = parser.parse_args()
+    if args.incremental and not args.cache_dir:
+        parser.error('--incremental needs --cache_dir')
     print(args)
 
     print('Start converting file...')
 
-    converter = Converter(RESOURCE_PATH + args.input_file, args.scale, args.precise)
+    cache = ModelCache(args.cache_dir, args.cache_size * 1024 * 1024, args.incremental) if args.cache_dir else None
+
+    converter = Converter(RESOURCE_PATH + args.input_file, args.scale, args.precise, args.stream, args.adaptive, args.bulk_merge, cache=cache,
+                          workers=args.workers)
     converter.generate_osm(RESOURCE_PATH + args.output_file, args.debug)
 
     print('All done')
@@ -3,17 +3,20 @@ import xml.etree.ElementTree as ET
 from math import fabs, sqrt, sin, cos, pi
 import matplotlib.pyplot as plt
 from datetime import datetime
+import numpy as np
 
-from opendrivepy.opendrive import OpenDrive
+from opendrivepy.cache import ModelCache, load_opendrive
 from opendrivepy.point import Point
 from tqdm import tqdm
-from pyqtree import Index
+from GridIndex import GridIndex
+from NodeMerge import merge_points, remap_ways
+from RoadWorkers import all_lane_lines
 
 from OSMtype import *
 from Utils import *
 import argparse
-import csv
-from pyproj import Proj
+from bisect import bisect_right
+from TableWriter import write_table, MAIN_COLUMNS, LANE_COLUMNS, FORMATS
 
 
 # To avoid the conflict between nodes
@@ -24,13 +27,31 @@ MAX_ARC_RADIUS = 50
 class Converter(object):
     """docstring for Converter"""
 
-    def __init__(self, filename, scene_scale, min_distance):
+    def __init__(self, filename, scene_scale, min_distance, stream=False, adaptive=False, bulk_merge=False, workers=1,
+                 opendrive=None, lane_lines=None, cache=None):
         super(Converter, self).__init__()
 
-        print("Reading OpenDrive file: " + filename)
-        self.opendrive = OpenDrive(filename)
+        # adaptive sampling keeps the sampled lanes within min_distance of the real ones
+        self.filename = filename
+        self.stream = stream
+        self.max_error = min_distance if adaptive else None
+        # the built models are reused from the cache (a ModelCache) when there is one
+        self.cache = cache
+        # the map and its lane centre lines can be shared with the other converters
+        if opendrive is None:
+            print("Reading OpenDrive file: " + filename)
+            opendrive = load_opendrive(filename, stream, self.max_error, cache)
+        self.opendrive = opendrive
+        self.lane_lines = lane_lines
         self.scale, minx, miny, maxx, maxy = self.set_scale(scene_scale)
         self.min_distance = min_distance
+        # merge the road samples in one pass after the roads instead of one by one
+        self.bulk_merge = bulk_merge
+        self.samples = list()
+        # the nodes (or samples) made by each way, for choose_main
+        self.way_nodes = dict()
+        # processes computing the lane centre lines of the roads
+        self.workers = workers
         # print(self.scale)
 
         print("Converting...")
@@ -38,7 +59,8 @@ class Converter(object):
         self.ways = dict()
         self.nodes = list()
 
-        self.spindex = Index(bbox=(minx, miny, maxx, maxy))
+        # the nodes are boxes of +-min_distance around them
+        self.spindex = GridIndex(2 * self.min_distance)
         self.convert()
 
     def set_scale(self, scene_scale):
@@ -82,15 +104,24 @@ class Converter(object):
                     if w_id in way_point and way_point[w_id]>=max_point_num:
                         choose=w_id
                         break
-        for node in self.nodes:
-            if node.way_id==choose:
-                node.is_mid=1
+        # with bulk merge the nodes are not created yet, the samples are marked
+        for node in self.way_nodes.get(choose, ()):
+            node.is_mid=1
+        # the ways of the section are done
+        for w_id in range(start,end):
+            self.way_nodes.pop(w_id, None)
+    # the lane centre lines of all the roads, in road order
+    def all_lane_lines(self):
+        if self.lane_lines is not None:
+            return self.lane_lines
+        return all_lane_lines(self.opendrive, self.workers, self.filename, self.stream, self.max_error, self.cache)
+
     def convert(self):
         # 1. convert all roads into nodes+ways
         way_id = 0
         
         with tqdm(total=len(self.opendrive.roads), ascii=True) as pbar:
-            for road_id, road in self.opendrive.roads.items():
+            for (road_id, road), lane_lines in zip(self.opendrive.roads.items(), self.all_lane_lines()):
                 #2350 2610
                 if road_id=='26':
                     print("here")
@@ -99,44 +130,40 @@ class Converter(object):
                 pbar.set_description("Processing road_id=%s" % road_id)
                 offset = 0
                 next_lane=None
+                rad_list, z_list = road.hdg_array.tolist(), road.z_list()
                 for lane_i,lane_section in enumerate(road.lane_section_list):
                     offset = 0
                     if lane_i+1>=len(road.lane_section_list):
                         next_lane=None
                     else:
                         next_lane=road.lane_section_list[lane_i+1]
-                    point_to_width=dict()
+                    start, stop = road.section_ranges[lane_i]
+                    lane_widths, lane_x, lane_y = lane_lines[lane_i][0]
+                    lane_widths, lane_x, lane_y = lane_widths.tolist(), lane_x.tolist(), lane_y.tolist()
                     lane_seq=0
                     way_point=dict()
                     max_point_num=0
                     start_way_id=way_id
-                    for lane in lane_section.left:
+                    for lane_j,lane in enumerate(lane_section.left):
                             lane_seq=lane_seq+1
                             way_nodes_id = list()
                             point_num=0
-                            for point in road.points:
-                                dis=point.s
-                                if lane_section.have_point(dis,next_lane):
+                            for j,i in enumerate(range(start, stop)):
+                                point_num+=1
+                                width=lane_widths[lane_j][j]
+                                # width=0
+                                if lane.type == "driving":
                                     point_num+=1
-                                    width=lane.get_width(dis-lane_section.s)
-                                    offset=0
-                                    if point in point_to_width:
-                                        offset=point_to_width[point]
-                                    point_to_width[point]=width+offset
-                                    # width=0
-                                    if lane.type == "driving":
-                                        point_num+=1
-                                        dx = cos(point.rad + pi / 2) * (offset+ (width / 2))
-                                        dy = sin(point.rad + pi / 2) * ( offset+ (width / 2))
-                                        _,_, n_left = lane_section.get_left_width()
-                                        node=Node(-1,point.x + dx,point.y + dy,point.z,lane_width=width,heading=point.rad + pi / 2,
-                                            road_id=road_id,lane_num=n_left,lane_seq=lane_seq,is_mid=0,way_id=way_id
-                                        )
-                                        new_node_id = self.add_node(node)
-                                        node.node_id=new_node_id
-                                        # print(new_node_id)
-                                        if not (new_node_id in way_nodes_id): # not exists in current way_nodes_id
-                                            way_nodes_id.append(new_node_id)
+                                    _,_, n_left = lane_section.get_left_width()
+                                    node=Node(-1,lane_x[lane_j][j],lane_y[lane_j][j],z_list[i],lane_width=width,heading=rad_list[i] + pi / 2,
+                                        road_id=road_id,lane_num=n_left,lane_seq=lane_seq,is_mid=0,way_id=way_id
+                                    )
+                                    new_node_id = self.add_sample_node(node)
+                                    node.node_id=new_node_id
+                                    # print(new_node_id)
+                                    way_nodes_id.append(new_node_id)
+                            # the repeated nodes are dropped once the lane is done, keeping the first ones
+                            way_nodes_id = unique_ids(way_nodes_id)
                             if len(way_nodes_id) > 0:
                                 ws_left, wd_left, n_left = lane_section.get_left_width()
                                 ws_right, wd_right, n_right = lane_section.get_right_width()
@@ -153,38 +180,32 @@ class Converter(object):
 
                     road.start_rway_id = way_id
                     offset = 0
-                    point_to_width=dict()
+                    lane_widths, lane_x, lane_y = lane_lines[lane_i][1]
+                    lane_widths, lane_x, lane_y = lane_widths.tolist(), lane_x.tolist(), lane_y.tolist()
                     lane_seq=0
                     way_point=dict()
                     max_point_num=0
                     start_way_id=way_id
-                    for lane in lane_section.right:
+                    for lane_j,lane in enumerate(lane_section.right):
                             lane_seq=lane_seq+1
                             way_nodes_id = list()
                             point_num=0
-                            for point in road.points:
-                                dis=point.s
-                                if lane_section.have_point(dis,next_lane):
-                                    width=lane.get_width(dis-lane_section.s)
-                                    offset=0
-                                    if point in point_to_width:
-                                        offset=point_to_width[point]
-                                    point_to_width[point]=width+offset
-                                    if lane.type == "driving":
-                                        point_num+=1
-                                        dx = cos(point.rad - pi / 2) * (offset+ (width / 2))
-                                        dy = sin(point.rad - pi / 2) * ( offset+(width / 2))
-                                        _,_, n_right = lane_section.get_right_width()
-                                        node=Node(-1, point.x + dx,point.y + dy,point.z,lane_width=width,heading=point.rad - pi / 2,
-                                            road_id=road_id,lane_num=n_right,lane_seq=lane_seq,is_mid=0,way_id=way_id
-                                        )
-                                        new_node_id = self.add_node(node)
-                                        node.node_id=new_node_id
-
-                                        # print(new_node_id)
-                                        if not (new_node_id in way_nodes_id): # not exists in current way_nodes_id
-                                            way_nodes_id.append(new_node_id)
-
+                            for j,i in enumerate(range(start, stop)):
+                                width=lane_widths[lane_j][j]
+                                if lane.type == "driving":
+                                    point_num+=1
+                                    _,_, n_right = lane_section.get_right_width()
+                                    node=Node(-1, lane_x[lane_j][j],lane_y[lane_j][j],z_list[i],lane_width=width,heading=rad_list[i] - pi / 2,
+                                        road_id=road_id,lane_num=n_right,lane_seq=lane_seq,is_mid=0,way_id=way_id
+                                    )
+                                    new_node_id = self.add_sample_node(node)
+                                    node.node_id=new_node_id
+
+                                    # print(new_node_id)
+                                    way_nodes_id.append(new_node_id)
+
+                            # the repeated nodes are dropped once the lane is done, keeping the first ones
+                            way_nodes_id = unique_ids(way_nodes_id)
                             if len(way_nodes_id) > 0:
                                 ws_left, wd_left, n_left = lane_section.get_left_width()
                                 ws_right, wd_right, n_right = lane_section.get_right_width()
@@ -203,6 +224,8 @@ class Converter(object):
                                     print("here")
                     self.choose_main(start_way_id,way_id,max_point_num,way_point)  
                 pbar.update(1)
+        if self.bulk_merge:
+            self.merge_nodes()
 
 
     def way_end_to_point(self, node_id, way_id):
@@ -222,6 +245,32 @@ class Converter(object):
 
 
 
+    def add_sample_node(self, node):
+        # with bulk merge the samples are only collected, merge_nodes turns them into nodes
+        if not self.bulk_merge:
+            node_id = self.add_node(node)
+            # only the new nodes, not the ones merged into an existing node
+            if self.nodes[node_id] is node:
+                self.way_nodes.setdefault(node.way_id, list()).append(node)
+            return node_id
+        self.samples.append(node)
+        self.way_nodes.setdefault(node.way_id, list()).append(node)
+        return len(self.samples) - 1
+
+    def merge_nodes(self):
+        labels, representatives = merge_points([(node.x, node.y, node.z, node.heading) for node in self.samples], self.min_distance)
+        # each group becomes a node, the one of its representative sample
+        start_id = self.node_id
+        for sample_id in representatives:
+            node = self.samples[sample_id]
+            node.node_id = self.node_id
+            self.nodes.append(node)
+            self.spindex.insert(
+                self.node_id, (node.x-self.min_distance, node.y-self.min_distance, node.x+self.min_distance, node.y+self.min_distance))
+            self.node_id = self.node_id + 1
+        remap_ways(self.ways, [start_id + label for label in labels])
+        self.samples = list()
+
     def add_node(self, node):
         # search for dup
         near_node_ids = self.spindex.intersect((node.x, node.y, node.x, node.y))
@@ -242,46 +291,39 @@ class Converter(object):
         return self.node_id - 1
 
 
-    def generate_osm(self, filename, debug = False):
+    def generate_osm(self, filename, debug = False, format = 'csv'):
 
-        wgs84_to_utm =Proj(proj='utm',zone=51,ellps='WGS84')
-        base_utmx,base_utmy=wgs84_to_utm(self.opendrive.lon,self.opendrive.lat)
+        projection = self.opendrive.projection()
         if debug:
             for node in self.nodes:
                 plt.plot(node.x, node.y, node.color)
             plt.show()
-        
-        csvfile = open(filename+"_main.csv", 'w')
-        writer = csv.writer(csvfile)
-        writer.writerow(['road_id', 'lon', 'lat','utmX','utmY','heading','mode','speed_mode','event_mode','oppsite_side_mode','lane_num','lane_seq','lane_width'])
-        data = [ ]
+
+        # all the nodes are projected at once
+        node_x = np.array([node.x for node in self.nodes])
+        node_y = np.array([node.y for node in self.nodes])
+        lon_list, lat_list = (np.asarray(c).tolist() for c in projection.lonlat(node_x, node_y))
+        utmx_list, utmy_list = (np.asarray(c).tolist() for c in projection.utm_xy(node_x, node_y))
+
+        # the rows of each road are together, the ways of a road follow its start_lway_id
+        # (a node shared with another road keeps the road_id it was made with)
+        road_starts = [road.start_lway_id for road in self.opendrive.roads.values()]
+        main_sizes, lane_sizes = [0] * len(road_starts), [0] * len(road_starts)
+        main_data, lane_data = [ ], [ ]
         for index, way_id in enumerate(self.ways):
             way_value = self.ways[way_id]
+            road_index = bisect_right(road_starts, way_id) - 1
             for way_node in way_value.nodes_id:
                 node=self.nodes[way_node]
                 if node.is_mid:
-                    utmx,utmy=base_utmx+node.x,base_utmy+node.y
-                    node_x,node_y= wgs84_to_utm(utmx,utmy,inverse=True)
-                    
-
-                    data.append((node.road_id,node_x,node_y,utmx,utmy,node.heading,0,3,0,0,node.lane_num,node.lane_seq,node.lane_width))
-        writer.writerows(data)
-        csvfile.close()
-        csvfile = open(filename+"_lane.csv", 'w')
-        writer = csv.writer(csvfile)
-        writer.writerow(['road_id' ,'lane_seq','lon', 'lat','utmX','utmY'])
-        data = [ ]
-        for index, way_id in enumerate(self.ways):
-            way_value = self.ways[way_id]
-            for way_node in way_value.nodes_id:
-                node=self.nodes[way_node]
+                    main_data.append((node.road_id,lon_list[way_node],lat_list[way_node],utmx_list[way_node],utmy_list[way_node],
+                                      node.heading,0,3,0,0,node.lane_num,node.lane_seq,node.lane_width))
+                    main_sizes[road_index] += 1
                 # if not node.is_mid:
-                utmx,utmy=base_utmx+node.x,base_utmy+node.y
-                node_x,node_y= wgs84_to_utm(utmx,utmy,inverse=True)
-                data.append((node.road_id,node.lane_seq,node_x,node_y,utmx,utmy))
-        writer.writerows(data)
-        csvfile.close()
-
+                lane_data.append((node.road_id,node.lane_seq,lon_list[way_node],lat_list[way_node],utmx_list[way_node],utmy_list[way_node]))
+                lane_sizes[road_index] += 1
+        write_table(filename+"_main", format, MAIN_COLUMNS, main_data, main_sizes)
+        write_table(filename+"_lane", format, LANE_COLUMNS, lane_data, lane_sizes)
 
 RESOURCE_PATH = "../resource/"
 
@@ -290,14 +332,26 @@ if __name__ == '__main__':
     parser.add_argument('--debug', type=bool, default=False, help='Is using debug mode')
     parser.add_argument('--input_file', type=str, default='new_undermap.xodr', help='Input OpenDRIVE file name')
     parser.add_argument('--scale', type=int, default=10000, help='Scale of xodr file (in meter)')
-    parser.add_argument('--precise', type=int, default=0.1, help='Precision of OSM file (in meter)')
+    parser.add_argument('--precise', type=float, default=0.1, help='Precision of OSM file (in meter)')
     parser.add_argument('--output_file', type=str, default='example', help='Output OSM file name')
+    parser.add_argument('--stream', action='store_true', help='Parse the OpenDRIVE file with iterparse instead of loading the whole DOM')
+    parser.add_argument('--adaptive', action='store_true', help='Sample the roads adaptively, with a chord error up to --precise, instead of every meter')
+    parser.add_argument('--bulk_merge', action='store_true', help='Merge the nodes closer than --precise in one KD-tree pass after sampling all the roads')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes sampling the roads and computing their lane centre lines')
+    parser.add_argument('--format', type=str, default='csv', choices=FORMATS, help='Format of the output tables, csv or the columnar parquet and arrow (need pyarrow)')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory of the cache of the built OpenDRIVE models, no cache by default')
+    parser.add_argument('--cache_size', type=int, default=1024, help='Size of the model cache (in MB), the least recently used models are removed beyond it')
+    parser.add_argument('--incremental', action='store_true', help='Reuse the roads, junctions and lane centre lines of the <road> and <junction> elements unchanged since the last conversion of the file (needs --cache_dir)')
     args = parser.parse_args()
+    if args.incremental and not args.cache_dir:
+        parser.error('--incremental needs --cache_dir')
     print(args)
 
     print('Start converting file...')
 
-    converter = Converter(RESOURCE_PATH + args.input_file, args.scale, args.precise)
-    converter.generate_osm(RESOURCE_PATH + args.output_file, args.debug)
+    cache = ModelCache(args.cache_dir, args.cache_size * 1024 * 1024, args.incremental) if args.cache_dir else None
+
+    converter = Converter(RESOURCE_PATH + args.input_file, args.scale, args.precise, args.stream, args.adaptive, args.bulk_merge, args.workers, cache=cache)
+    converter.generate_osm(RESOURCE_PATH + args.output_file, args.debug, args.format)
 
     print('All done')
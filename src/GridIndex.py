@@ -0,0 +1,63 @@
+from __future__ import division, absolute_import, print_function
+from math import floor
+
+
+class GridIndex(object):
+    """Spatial hash of bounding boxes, with the insert / intersect interface of pyqtree.Index"""
+
+    # Items are hashed by the cell of the lower corner of their box, cells are
+    # squares of side cell_size, the best being the usual size of the boxes
+    # A query looks into the cells where the lower corner of an intersecting
+    # box can be, up to the largest box inserted away from the query
+    # The grid has no bounds: cells are created as items are inserted
+    def __init__(self, cell_size):
+        super(GridIndex, self).__init__()
+        # boxes of a zero min distance only match equal points, any cell size works then
+        self.cell_size = cell_size if cell_size > 0 else 1.0
+        self.cells = dict()
+        self.max_width = 0
+        self.max_height = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def insert(self, item, bbox):
+        x1, y1, x2, y2 = normalize_rect(bbox)
+        key = (floor(x1 / self.cell_size), floor(y1 / self.cell_size))
+        cell = self.cells.get(key)
+        if cell is None:
+            cell = self.cells[key] = list()
+        cell.append((self.count, item, x1, y1, x2, y2))
+        if x2 - x1 > self.max_width:
+            self.max_width = x2 - x1
+        if y2 - y1 > self.max_height:
+            self.max_height = y2 - y1
+        self.count += 1
+
+    # The items whose box intersects bbox (bounds included), in insertion order
+    def intersect(self, bbox):
+        x1, y1, x2, y2 = normalize_rect(bbox)
+        size = self.cell_size
+        cells = self.cells
+        found = list()
+        for cx in range(floor((x1 - self.max_width) / size), floor(x2 / size) + 1):
+            for cy in range(floor((y1 - self.max_height) / size), floor(y2 / size) + 1):
+                cell = cells.get((cx, cy))
+                if cell is None:
+                    continue
+                for entry in cell:
+                    if entry[4] >= x1 and entry[2] <= x2 and entry[5] >= y1 and entry[3] <= y2:
+                        found.append(entry)
+        if len(found) > 1:
+            found.sort()
+        return [entry[1] for entry in found]
+
+
+def normalize_rect(bbox):
+    x1, y1, x2, y2 = bbox
+    if x1 > x2:
+        x1, x2 = x2, x1
+    if y1 > y2:
+        y1, y2 = y2, y1
+    return x1, y1, x2, y2
@@ -0,0 +1,226 @@
+from __future__ import division, absolute_import, print_function
+import argparse
+import asyncio
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from opendrivepy.cache import ModelCache, load_opendrive
+
+# A local HTTP service answering map queries, on a TCP port of localhost or on
+# a Unix socket. The OpenDRIVE files are parsed once and their road and lane
+# indexes built before the first request, the queries then only read them
+# The connections are served by asyncio, the queries run in a thread pool
+#
+# GET /maps                                          the names of the maps
+# GET /on_road?map=NAME&x=X1,X2..&y=Y1,Y2..          whether the points are on a road
+# GET /nearest_lane?map=NAME&x=X1,X2..&y=Y1,Y2..     road id, lane id, s and t of the points
+# GET /bbox_lanes?map=NAME&x1=X1&y1=Y1&x2=X2&y2=Y2   the lane centre lines reaching into the box
+#
+# The coordinates are the local x, y of the map, the name of a map is its file
+# name without extension. The answers are JSON objects, {"error": ...} with a
+# 400 or 404 status when the query is wrong, 414 or 431 when the request line
+# or a header line is longer than LINE_LIMIT, and 500 when the query fails
+
+
+class MapServer(object):
+    def __init__(self, maps, workers=4):
+        super(MapServer, self).__init__()
+        self.maps = maps
+        self.executor = ThreadPoolExecutor(workers)
+        self.queries = {'/maps': self.list_maps, '/on_road': self.on_road,
+                        '/nearest_lane': self.nearest_lane, '/bbox_lanes': self.bbox_lanes}
+
+    # The indexes are built lazily, they are all built here so that the
+    # queries never build them from several threads
+    def warm_up(self):
+        for opendrive in self.maps.values():
+            opendrive.roadmap.build()
+            opendrive.roadmap.build_lane_tree()
+
+    async def serve(self, host, port, socket=None):
+        if socket is not None:
+            server = await asyncio.start_unix_server(self.handle, socket, limit=LINE_LIMIT)
+            print("Serving %s on %s" % (', '.join(sorted(self.maps)), socket))
+        else:
+            server = await asyncio.start_server(self.handle, host, port, limit=LINE_LIMIT)
+            print("Serving %s on http://%s:%d" % (', '.join(sorted(self.maps)), host, port))
+        async with server:
+            await server.serve_forever()
+
+    # One connection: HTTP/1.1 requests are answered until the client closes it
+    # or asks to, HTTP/1.0 ones one per connection
+    # readline raises ValueError past the limit of the stream, the rest of the
+    # request cannot be read then and the connection is closed after the answer
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await reader.readline()
+                except ValueError:
+                    await reject(writer, 414, 'request line longer than %d bytes' % LINE_LIMIT)
+                    break
+                if not request:
+                    break
+                headers = dict()
+                try:
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        key, _, value = line.decode('latin-1').partition(':')
+                        headers[key.strip().lower()] = value.strip()
+                except ValueError:
+                    await reject(writer, 431, 'header line longer than %d bytes' % LINE_LIMIT)
+                    break
+                request = request.decode('latin-1').split()
+                status, answer = await self.answer(request)
+                keep_alive = len(request) == 3 and request[2] == 'HTTP/1.1' and \
+                    headers.get('connection', '').lower() != 'close'
+                writer.write(http_response(status, answer, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def answer(self, request):
+        if len(request) != 3 or request[0] != 'GET':
+            return 400, {'error': 'only GET requests are served'}
+        try:
+            url = urlsplit(request[1])
+        except ValueError as e:
+            return 400, {'error': 'invalid URL: %s' % e}
+        query = self.queries.get(url.path)
+        if query is None:
+            return 404, {'error': 'unknown query ' + url.path}
+        params = dict((key, values[-1]) for key, values in parse_qs(url.query).items())
+        try:
+            return 200, await asyncio.get_running_loop().run_in_executor(self.executor, query, params)
+        except LookupError as e:
+            return 404, {'error': str(e.args[0])}
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            traceback.print_exc()
+            return 500, {'error': '%s: %s' % (type(e).__name__, e)}
+
+    def list_maps(self, params):
+        return {'maps': sorted(self.maps)}
+
+    def on_road(self, params):
+        roadmap = self.roadmap(params)
+        x, y = points(params)
+        return {'on_road': roadmap.on_roads(x, y).tolist()}
+
+    def nearest_lane(self, params):
+        roadmap = self.roadmap(params)
+        x, y = points(params)
+        road_ids, lane_ids, s, t = roadmap.match(x, y)
+        return {'road': road_ids.tolist(), 'lane': lane_ids.tolist(), 's': json_floats(s), 't': json_floats(t)}
+
+    def bbox_lanes(self, params):
+        roadmap = self.roadmap(params)
+        x1, y1, x2, y2 = [number(params, key) for key in ('x1', 'y1', 'x2', 'y2')]
+        lanes = roadmap.lanes_in_box(min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        return {'lanes': [{'road': road_id, 'lane': lane_id, 's': s.tolist(), 'x': x.tolist(), 'y': y.tolist()}
+                          for road_id, lane_id, s, x, y in lanes]}
+
+    def roadmap(self, params):
+        name = params.get('map')
+        if name is None and len(self.maps) == 1:
+            name = next(iter(self.maps))
+        if name not in self.maps:
+            raise LookupError('unknown map %s' % name)
+        return self.maps[name].roadmap
+
+
+def number(params, key):
+    if key not in params:
+        raise ValueError('missing ' + key)
+    try:
+        return float(params[key])
+    except ValueError:
+        raise ValueError('%s is not a number: %s' % (key, params[key]))
+
+
+# The x and y of the points, comma separated
+def points(params):
+    coords = list()
+    for key in ('x', 'y'):
+        if key not in params:
+            raise ValueError('missing ' + key)
+        try:
+            coords.append(np.array([float(value) for value in params[key].split(',')]))
+        except ValueError:
+            raise ValueError('%s is not a list of numbers: %s' % (key, params[key]))
+    if len(coords[0]) != len(coords[1]):
+        raise ValueError('x and y have different lengths')
+    return coords
+
+
+# JSON has no nan, the points off the lanes get null
+def json_floats(values):
+    return [None if value != value else value for value in values.tolist()]
+
+
+# Longest request or header line read, the limit of the asyncio streams
+LINE_LIMIT = 64 * 1024
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 414: 'URI Too Long',
+           431: 'Request Header Fields Too Large', 500: 'Internal Server Error'}
+
+
+def http_response(status, answer, keep_alive):
+    body = json.dumps(answer).encode('utf-8')
+    headers = ['HTTP/1.1 %d %s' % (status, REASONS[status]),
+               'Content-Type: application/json',
+               'Content-Length: %d' % len(body),
+               'Connection: %s' % ('keep-alive' if keep_alive else 'close')]
+    return ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1') + body
+
+
+# Answers an error, the connection is closed after it
+async def reject(writer, status, error):
+    writer.write(http_response(status, {'error': error}, False))
+    await writer.drain()
+
+
+RESOURCE_PATH = "../resource/"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serves road and lane queries on OpenDRIVE maps kept in memory')
+    parser.add_argument('--input_files', type=str, default='Town03.xodr', help='Comma separated input OpenDRIVE file names')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address the HTTP server listens on')
+    parser.add_argument('--port', type=int, default=8765, help='Port the HTTP server listens on')
+    parser.add_argument('--socket', type=str, default=None, help='Unix socket to listen on instead of the TCP port')
+    parser.add_argument('--workers', type=int, default=4, help='Number of threads answering the queries')
+    parser.add_argument('--precise', type=float, default=0.1, help='Chord error of the adaptive sampling (in meter)')
+    parser.add_argument('--stream', action='store_true', help='Parse the OpenDRIVE file with iterparse instead of loading the whole DOM')
+    parser.add_argument('--adaptive', action='store_true', help='Sample the roads adaptively, with a chord error up to --precise, instead of every meter')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Directory of the cache of the built OpenDRIVE models, no cache by default')
+    parser.add_argument('--cache_size', type=int, default=1024, help='Size of the model cache (in MB), the least recently used models are removed beyond it')
+    args = parser.parse_args()
+    print(args)
+
+    cache = ModelCache(args.cache_dir, args.cache_size * 1024 * 1024) if args.cache_dir else None
+    max_error = args.precise if args.adaptive else None
+
+    maps = dict()
+    for input_file in args.input_files.split(','):
+        print("Reading OpenDrive file: " + RESOURCE_PATH + input_file)
+        maps[os.path.splitext(os.path.basename(input_file))[0]] = load_opendrive(RESOURCE_PATH + input_file, args.stream,
+                                                                                 max_error, cache)
+    server = MapServer(maps, args.workers)
+    server.warm_up()
+
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.socket))
+    except KeyboardInterrupt:
+        print('Stopped')
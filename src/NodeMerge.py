@@ -0,0 +1,43 @@
+from __future__ import division, absolute_import, print_function
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from Utils import unique_ids
+
+# Bulk node deduplication, the batch alternative to the add_node queries:
+# every sample is generated first, then all of them are merged in one pass
+
+
+def merge_points(points, min_distance):
+    # Group the points closer than min_distance on both axes (the +-min_distance
+    # boxes of add_node), transitively: the groups are the connected components
+    # of the pairs found by the KD-tree, so they do not depend on the point order
+    # The points are (x, y, ...) rows, the columns after x and y only break the
+    # ties. Each group is represented by its lowest point, comparing the rows
+    # column by column, and the groups are numbered in the order of their
+    # representatives, so that neither depends on the point order either
+    # Returns the group of each point and the index of the representative of
+    # each group
+    if len(points) == 0:
+        return list(), list()
+    points = np.asarray(points, dtype=float).reshape(len(points), -1)
+    pairs = cKDTree(points[:, :2]).query_pairs(min_distance, p=np.inf, output_type='ndarray')
+    graph = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(len(points), len(points)))
+    _, labels = connected_components(graph, directed=False)
+
+    # the points sorted by x, then y..., the first one of each group in that
+    # order is its representative
+    order = np.lexsort(points.T[::-1])
+    _, first = np.unique(labels[order], return_index=True)
+    representatives = order[np.sort(first)]
+    rank = np.empty(len(representatives), dtype=int)
+    rank[labels[representatives]] = np.arange(len(representatives))
+    return rank[labels].tolist(), representatives.tolist()
+
+
+def remap_ways(ways, labels):
+    # replace the sample ids of the ways by their node ids, keeping the first
+    # occurrence of a node as add_node does
+    for way in ways.values():
+        way.nodes_id = unique_ids(labels[sample_id] for sample_id in way.nodes_id)
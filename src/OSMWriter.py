@@ -0,0 +1,75 @@
+from __future__ import division, absolute_import, print_function
+import re
+
+
+class OSMWriter(object):
+    """Streams an OSM XML document to a file, element by element"""
+
+    # The output is what xml.etree.ElementTree writes for the same tree (no XML
+    # declaration, us-ascii with character references, ' />' for the empty
+    # elements) but nothing is kept in memory: every node and way is written
+    # as soon as it is given
+    def __init__(self, filename):
+        super(OSMWriter, self).__init__()
+        self.file = open(filename, 'w', encoding='us-ascii', errors='xmlcharrefreplace')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def start(self, tag, attrib):
+        self.file.write('<%s%s>' % (tag, attributes(attrib)))
+
+    def end(self, tag):
+        self.file.write('</%s>' % tag)
+
+    def empty(self, tag, attrib):
+        self.file.write(empty_element(tag, attrib))
+
+    # The OSM elements, with the fixed attributes of the converter
+    # tags are (k, v) pairs, the values are written with str()
+    def node(self, node_id, lon, lat, timestamp, tags):
+        self.file.write(NODE_FORMAT % (node_id, timestamp, lon, lat) + tag_elements(tags) + '</node>')
+
+    # refs are the node ids of the way
+    def way(self, way_id, refs, timestamp, tags):
+        self.file.write(WAY_FORMAT % (way_id, timestamp) + ''.join(['<nd ref="%d" />' % ref for ref in refs]) +
+                        tag_elements(tags) + '</way>')
+
+
+NODE_FORMAT = ('<node id="%d" visible="true" version="1" changeset="1" timestamp="%s" user="simon" uid="1" '
+               'lon="%s" lat="%s" ele="2">')
+WAY_FORMAT = '<way id="%d" version="1" changeset="1" timestamp="%s" user="simon" uid="1">'
+
+
+def tag_elements(tags):
+    return ''.join(['<tag k="%s" v="%s" />' % (escape_attrib(str(key)), escape_attrib(str(value))) for key, value in tags])
+
+
+def empty_element(tag, attrib):
+    return '<%s%s />' % (tag, attributes(attrib))
+
+
+def attributes(attrib):
+    return ''.join([' %s="%s"' % (key, escape_attrib(value)) for key, value in attrib.items()])
+
+
+# the escapes of ElementTree
+ATTRIB_ESCAPES = (('&', '&amp;'), ('<', '&lt;'), ('>', '&gt;'), ('"', '&quot;'),
+                  ('\r', '&#13;'), ('\n', '&#10;'), ('\t', '&#09;'))
+NEEDS_ESCAPE = re.compile('[&<>"\r\n\t]').search
+
+
+def escape_attrib(value):
+    # most values have nothing to escape
+    if NEEDS_ESCAPE(value) is None:
+        return value
+    for char, entity in ATTRIB_ESCAPES:
+        if char in value:
+            value = value.replace(char, entity)
+    return value
@@ -0,0 +1,242 @@
+from __future__ import division, absolute_import, print_function
+import struct
+import zlib
+from calendar import timegm
+from time import strptime
+import numpy as np
+
+
+class PBFWriter(object):
+    """Streams an OSM PBF file, with the element interface of OSMWriter"""
+
+    # The nodes are written as dense nodes and the ways with delta coded refs,
+    # each block with its own string table. A block is compressed and written
+    # as soon as it holds BLOCK_SIZE elements of one kind
+    # The osm and bounds elements make the header block: the generator is the
+    # writing program and the bounds the bounding box. It is written before the
+    # first data block
+    def __init__(self, filename):
+        super(PBFWriter, self).__init__()
+        self.file = open(filename, 'wb')
+        self.generator = None
+        self.bbox = None
+        self.header_written = False
+        self.timestamps = dict()
+        self.reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.write_header()
+            self.file.close()
+
+    def start(self, tag, attrib):
+        if tag == 'osm':
+            self.generator = attrib.get('generator')
+
+    def end(self, tag):
+        if tag == 'osm':
+            self.flush()
+
+    def empty(self, tag, attrib):
+        if tag == 'bounds':
+            self.bbox = [float(attrib[key]) for key in ('minlon', 'maxlon', 'maxlat', 'minlat')]
+
+    # The version, changeset, user and uid are the ones of OSMWriter
+    # The ele attribute of the XML nodes is not part of the PBF format
+    def node(self, node_id, lon, lat, timestamp, tags):
+        if self.way_ids:
+            self.flush()
+        self.node_ids.append(node_id)
+        self.lons.append(lon)
+        self.lats.append(lat)
+        self.node_timestamps.append(self.epoch(timestamp))
+        for key, value in tags:
+            self.keys_vals.append(self.string_id(str(key)))
+            self.keys_vals.append(self.string_id(str(value)))
+        self.keys_vals.append(0)
+        if len(self.node_ids) >= BLOCK_SIZE:
+            self.flush()
+
+    def way(self, way_id, refs, timestamp, tags):
+        if self.node_ids:
+            self.flush()
+        self.way_ids.append(way_id)
+        self.refs.append(refs)
+        self.way_timestamps.append(self.epoch(timestamp))
+        self.way_keys.append([self.string_id(str(key)) for key, value in tags])
+        self.way_vals.append([self.string_id(str(value)) for key, value in tags])
+        if len(self.way_ids) >= BLOCK_SIZE:
+            self.flush()
+
+    # the timestamps are the strings of the XML, in seconds since the epoch
+    def epoch(self, timestamp):
+        seconds = self.timestamps.get(timestamp)
+        if seconds is None:
+            seconds = self.timestamps[timestamp] = timegm(strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ'))
+        return seconds
+
+    # The index of a string in the table of the current block
+    # 0 is kept empty, it ends the tags of a node in the dense nodes
+    def string_id(self, string):
+        index = self.string_ids.get(string)
+        if index is None:
+            index = self.string_ids[string] = len(self.strings)
+            self.strings.append(string.encode('utf-8'))
+        return index
+
+    def reset(self):
+        self.strings = [b'']
+        self.string_ids = dict()
+        self.node_ids = list()
+        self.lons = list()
+        self.lats = list()
+        self.node_timestamps = list()
+        self.keys_vals = list()
+        self.way_ids = list()
+        self.refs = list()
+        self.way_timestamps = list()
+        self.way_keys = list()
+        self.way_vals = list()
+
+    def flush(self):
+        if self.node_ids:
+            group = message_bytes(2, self.dense_nodes())
+        elif self.way_ids:
+            group = b''.join(self.ways())
+        else:
+            return
+        string_table = b''.join([message_bytes(1, string) for string in self.strings])
+        self.write_header()
+        write_blob(self.file, 'OSMData', message_bytes(1, string_table) + message_bytes(2, group))
+        self.reset()
+
+    def write_header(self):
+        if self.header_written:
+            return
+        header = b''
+        if self.bbox is not None:
+            header += message_bytes(1, b''.join([message_varint(field, zigzag(round(value * 1e9)))
+                                                 for field, value in enumerate(self.bbox, 1)]))
+        header += message_bytes(4, b'OsmSchema-V0.6') + message_bytes(4, b'DenseNodes')
+        if self.generator:
+            header += message_bytes(16, self.generator.encode('utf-8'))
+        write_blob(self.file, 'OSMHeader', header)
+        self.header_written = True
+
+    # The lon and lat are in units of 1e-7 degree, the default granularity
+    def dense_nodes(self):
+        count = len(self.node_ids)
+        user = self.string_id(USER)
+        info = (message_bytes(1, varints(np.full(count, VERSION))[0]) +
+                message_bytes(2, delta_varints(self.node_timestamps)) +
+                message_bytes(3, delta_varints(np.full(count, CHANGESET))) +
+                message_bytes(4, delta_varints(np.full(count, UID))) +
+                message_bytes(5, delta_varints(np.full(count, user))))
+        return (message_bytes(1, delta_varints(self.node_ids)) +
+                message_bytes(5, info) +
+                message_bytes(8, delta_varints(np.round(np.asarray(self.lats, dtype=float) * 1e7))) +
+                message_bytes(9, delta_varints(np.round(np.asarray(self.lons, dtype=float) * 1e7))) +
+                message_bytes(10, varints(self.keys_vals)[0]))
+
+    # One message per way, the packed fields of all the ways of the block are
+    # encoded at once and cut per way
+    def ways(self):
+        user = self.string_id(USER)
+        counts = [len(refs) for refs in self.refs]
+        refs = np.concatenate([np.asarray(refs, dtype=np.int64) for refs in self.refs] + [np.zeros(0, np.int64)])
+        starts = np.cumsum([0] + counts)[:-1]
+        # the deltas restart at each way
+        starts = starts[np.array(counts) > 0]
+        deltas = np.diff(refs, prepend=0)
+        deltas[starts] = refs[starts]
+        refs = split_varints(zigzag(deltas), counts)
+        keys = split_varints([key for keys in self.way_keys for key in keys], [len(keys) for keys in self.way_keys])
+        vals = split_varints([val for vals in self.way_vals for val in vals], [len(vals) for vals in self.way_vals])
+        ways = list()
+        for way_id, timestamp, way_keys, way_vals, way_refs in zip(self.way_ids, self.way_timestamps, keys, vals, refs):
+            info = (message_varint(1, VERSION) + message_varint(2, timestamp) + message_varint(3, CHANGESET) +
+                    message_varint(4, UID) + message_varint(5, user))
+            way = message_varint(1, way_id)
+            if way_keys:
+                way += message_bytes(2, way_keys) + message_bytes(3, way_vals)
+            way += message_bytes(4, info)
+            if way_refs:
+                way += message_bytes(8, way_refs)
+            ways.append(message_bytes(3, way))
+        return ways
+
+
+# elements in a block, as osmium writes them
+BLOCK_SIZE = 8000
+
+VERSION = 1
+CHANGESET = 1
+UID = 1
+USER = 'simon'
+
+
+# A file block: the size of its header, the header and the zlib compressed message
+def write_blob(file, kind, message):
+    blob = message_varint(2, len(message)) + message_bytes(3, zlib.compress(message))
+    header = message_bytes(1, kind.encode('ascii')) + message_varint(3, len(blob))
+    file.write(struct.pack('>I', len(header)) + header + blob)
+
+
+# Protocol buffers encoding
+def varint(value):
+    data = bytearray()
+    while value > 0x7f:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def message_varint(field, value):
+    return varint(field << 3) + varint(value)
+
+
+def message_bytes(field, data):
+    return varint(field << 3 | 2) + varint(len(data)) + data
+
+
+def zigzag(values):
+    if np.isscalar(values):
+        return (values << 1) ^ (values >> 63)
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+# The varints of an array of unsigned integers, and the number of bytes of each
+def varints(values):
+    values = np.asarray(values, dtype=np.uint64).reshape(-1)
+    groups = (values[:, None] >> np.arange(0, 70, 7, dtype=np.uint64)) & np.uint64(0x7f)
+    nonzero = groups != 0
+    lengths = np.where(nonzero.any(axis=1), groups.shape[1] - np.argmax(nonzero[:, ::-1], axis=1), 1)
+    columns = np.arange(groups.shape[1])
+    # the continuation bit is on all the bytes but the last
+    groups[columns < lengths[:, None] - 1] |= np.uint64(0x80)
+    used = columns < lengths[:, None]
+    return groups[used].astype(np.uint8).tobytes(), lengths
+
+
+# The packed sint64 of the deltas of the values
+def delta_varints(values):
+    values = np.asarray(values, dtype=np.int64)
+    return varints(zigzag(np.diff(values, prepend=0)))[0]
+
+
+# The varints of the values cut in groups of counts values
+def split_varints(values, counts):
+    data, lengths = varints(values)
+    ends = np.cumsum(lengths)[np.cumsum(counts) - 1] if len(lengths) else np.zeros(len(counts), int)
+    ends = np.where(np.array(counts) > 0, ends, 0)
+    ends = np.maximum.accumulate(ends).tolist()
+    return [data[start:end] for start, end in zip([0] + ends[:-1], ends)]
@@ -0,0 +1,95 @@
+from __future__ import division, absolute_import, print_function
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from opendrivepy.cache import load_opendrive
+
+# The per road work of the converters that only reads the road, done in a pool
+# of processes: the workers sample their roads and compute their lane centre
+# lines, the samples go back into the roads of the converter. The results
+# come back in road order, the converters number the nodes and ways from them
+# as with a single process
+
+
+def road_lane_lines(road):
+    # The lane centre lines of a road: for each lane section the (widths, x, y)
+    # arrays of its left and right lanes, one row per lane
+    return [(road.lane_center_lines(lane_i, 'left'), road.lane_center_lines(lane_i, 'right'))
+            for lane_i in range(len(road.lane_section_list))]
+
+
+# The OpenDrive the workers read their roads from: forked workers inherit the
+# one of the converter, spawned ones parse the file again (or load it from the
+# cache, read only: the converter writes its entries)
+worker_opendrive = None
+
+
+def init_worker(filename, stream, max_error, cache):
+    global worker_opendrive
+    if worker_opendrive is None:
+        worker_opendrive = load_opendrive(filename, stream, max_error, cache.reader() if cache is not None else None)
+
+
+def road_results(road, lane_lines):
+    # The samples of the road, unless it was sampled before the worker started,
+    # and its lane centre lines when asked
+    samples = None if road.is_sampled() else road.samples()
+    return samples, road_lane_lines(road) if lane_lines else None
+
+
+def roads_worker(road_ids, lane_lines):
+    return [road_results(worker_opendrive.roads[road_id], lane_lines) for road_id in road_ids]
+
+
+def all_lane_lines(opendrive, workers, filename, stream=False, max_error=None, cache=None):
+    # road_lane_lines of every road of opendrive, in road order
+    # filename, stream, max_error and cache are how it was loaded, for spawned workers
+    # An incremental cache gives back the lines of the unchanged roads
+    road_cache = cache.road_cache(filename, max_error) if cache is not None else None
+    if road_cache is None:
+        return lane_lines_of(opendrive, list(opendrive.roads), workers, filename, stream, max_error, cache)
+    return road_cache.lane_lines(opendrive, lambda road_ids: lane_lines_of(
+        opendrive, road_ids, workers, filename, stream, max_error, cache))
+
+
+def lane_lines_of(opendrive, road_ids, workers, filename, stream, max_error, cache):
+    # road_lane_lines of the given roads, in their order
+    return map_roads(opendrive, road_ids, True, workers, filename, stream, max_error, cache)
+
+
+def sample_roads(opendrive, workers, filename, stream=False, max_error=None, cache=None):
+    # Samples the roads of opendrive not sampled yet, in workers processes
+    road_ids = [road_id for road_id, road in opendrive.roads.items() if not road.is_sampled()]
+    for _ in map_roads(opendrive, road_ids, False, workers, filename, stream, max_error, cache):
+        pass
+
+
+def map_roads(opendrive, road_ids, lane_lines, workers, filename, stream, max_error, cache):
+    # The lane centre lines of the given roads (None without lane_lines), in
+    # their order, the roads are sampled on the way
+    global worker_opendrive
+    if workers <= 1 or not road_ids:
+        for road_id in road_ids:
+            road = opendrive.roads[road_id]
+            road.sample_once()
+            yield road_lane_lines(road) if lane_lines else None
+        return
+
+    # a few chunks per worker to balance the load
+    size = max(1, -(-len(road_ids) // (workers * 4)))
+    chunks = [road_ids[i:i+size] for i in range(0, len(road_ids), size)]
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    worker_opendrive = opendrive
+    try:
+        with ProcessPoolExecutor(workers, context, init_worker, (filename, stream, max_error, cache)) as executor:
+            for chunk, results in zip(chunks, executor.map(roads_worker, chunks, [lane_lines] * len(chunks))):
+                for road_id, (samples, road_lines) in zip(chunk, results):
+                    road = opendrive.roads[road_id]
+                    if samples is not None and not road.is_sampled():
+                        road.set_samples(samples)
+                    yield road_lines
+    finally:
+        worker_opendrive = None
@@ -0,0 +1,69 @@
+from __future__ import division, absolute_import, print_function
+import csv
+
+# Writers of the semantic map tables, as csv or as typed columnar files
+# The columns are (name, type) pairs, the types are Arrow type names
+# The rows come with the number of rows of each road: in parquet every road
+# is a row group, in arrow (the IPC file format, memory mappable) a record batch
+
+MAIN_COLUMNS = [('road_id', 'string'), ('lon', 'float64'), ('lat', 'float64'), ('utmX', 'float64'), ('utmY', 'float64'),
+                ('heading', 'float64'), ('mode', 'int32'), ('speed_mode', 'int32'), ('event_mode', 'int32'),
+                ('oppsite_side_mode', 'int32'), ('lane_num', 'int32'), ('lane_seq', 'int32'), ('lane_width', 'float64')]
+LANE_COLUMNS = [('road_id', 'string'), ('lane_seq', 'int32'), ('lon', 'float64'), ('lat', 'float64'),
+                ('utmX', 'float64'), ('utmY', 'float64')]
+
+FORMATS = ['csv', 'parquet', 'arrow']
+
+
+# Writes filename + '.' + format
+def write_table(filename, format, columns, rows, group_sizes):
+    if format == 'csv':
+        write_csv(filename + '.csv', columns, rows)
+    elif format == 'parquet':
+        write_parquet(filename + '.parquet', columns, rows, group_sizes)
+    elif format == 'arrow':
+        write_arrow(filename + '.arrow', columns, rows, group_sizes)
+    else:
+        raise ValueError("Unknown table format: " + format)
+
+
+def write_csv(filename, columns, rows):
+    csvfile = open(filename, 'w')
+    writer = csv.writer(csvfile)
+    writer.writerow([name for name, _ in columns])
+    writer.writerows(rows)
+    csvfile.close()
+
+
+def write_parquet(filename, columns, rows, group_sizes):
+    import pyarrow.parquet as pq
+    table = arrow_table(columns, rows)
+    with pq.ParquetWriter(filename, table.schema) as writer:
+        for offset, size in groups(group_sizes):
+            writer.write_table(table.slice(offset, size))
+
+
+def write_arrow(filename, columns, rows, group_sizes):
+    import pyarrow as pa
+    table = arrow_table(columns, rows)
+    with pa.OSFile(filename, 'wb') as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            for offset, size in groups(group_sizes):
+                writer.write_table(table.slice(offset, size), max_chunksize=size)
+
+
+# pyarrow is only needed by the columnar formats
+def arrow_table(columns, rows):
+    import pyarrow as pa
+    values = list(zip(*rows)) if rows else [[] for _ in columns]
+    return pa.table([pa.array(column, type=pa.type_for_alias(type)) for column, (_, type) in zip(values, columns)],
+                    names=[name for name, _ in columns])
+
+
+# (offset, size) of the non empty groups
+def groups(group_sizes):
+    offset = 0
+    for size in group_sizes:
+        if size > 0:
+            yield offset, size
+        offset += size
@@ -2,6 +2,12 @@ from math import fabs, sqrt
 from geompreds import orient2d, incircle
 from opendrivepy.point import Point
 
+def unique_ids(ids):
+    # ids without the repeats, in order of first occurrence
+    # a dict keeps the insertion order and checks membership in O(1)
+    return list(dict.fromkeys(ids))
+
+
 def point_distance(pointa, pointb):
     return sqrt((pointa.x - pointb.x) ** 2 + (pointa.y - pointb.y) ** 2)
 
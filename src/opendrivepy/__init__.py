@@ -0,0 +1,2 @@
+# Version of the model, the cached models of other versions are not used
+__version__ = '0.3.0'
@@ -0,0 +1,211 @@
+from __future__ import division, print_function, absolute_import
+
+import gc
+import hashlib
+import os
+import pickle
+import tempfile
+
+from lxml import etree
+
+import opendrivepy
+from opendrivepy.opendrive import OpenDrive
+
+
+# On disk cache of the built OpenDrive models, the sampled roads with their
+# arrays, lanes and junctions, as they are after OpenDrive.__init__
+# An entry is keyed by the content of the file, the sampling (max_error) and
+# the version of opendrivepy. stream is not part of the key, both parsers
+# build the same model
+# With incremental, the roads of the last model built from a file and their
+# lane centre lines are kept instead (see RoadCache): a file that changed only
+# rebuilds its changed roads
+# The entries are evicted least recently used first, once the cache is over
+# max_size bytes: reading an entry updates its modification time
+# A read only cache (the one of the worker processes) never changes the entries
+class ModelCache(object):
+    def __init__(self, directory, max_size=1024 * 1024 * 1024, incremental=False, read_only=False):
+        super(ModelCache, self).__init__()
+        self.directory = directory
+        self.max_size = max_size
+        self.incremental = incremental
+        self.read_only = read_only
+
+    # The same cache, read only
+    def reader(self):
+        return ModelCache(self.directory, self.max_size, self.incremental, True)
+
+    def load(self, filename, stream=False, max_error=None):
+        # incremental keeps the roads of the file instead of the whole model
+        road_cache = self.road_cache(filename, max_error)
+        if road_cache is not None:
+            opendrive = OpenDrive(filename, stream, max_error, road_cache)
+            road_cache.save_roads()
+            return opendrive
+
+        path = os.path.join(self.directory, model_key(filename, max_error) + '.pickle')
+        opendrive = self.read(path)
+        if opendrive is None:
+            opendrive = OpenDrive(filename, stream, max_error)
+            self.write(path, opendrive)
+        return opendrive
+
+    # The RoadCache of the file, None when not incremental
+    # It is shared by the model and the lane centre lines of the same run
+    def road_cache(self, filename, max_error):
+        if not self.incremental:
+            return None
+        key = (self.directory, os.path.abspath(filename), max_error)
+        if key not in road_caches:
+            road_caches[key] = RoadCache(self, filename, max_error)
+        return road_caches[key]
+
+    def read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                # the entries are many small objects, the collector only slows the load
+                gc.disable()
+                try:
+                    entry = pickle.load(f)
+                finally:
+                    gc.enable()
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print("Dropping the unreadable cache entry %s: %s" % (path, e))
+            if not self.read_only:
+                remove(path)
+            return None
+        if not self.read_only:
+            os.utime(path)
+        return entry
+
+    # The entry is written to a temporary file then renamed, readers never see
+    # a partial one. The cache is only an optimization: errors are printed
+    def write(self, path, entry):
+        if self.read_only:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            handle, temp_path = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            with os.fdopen(handle, 'wb') as f:
+                pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, path)
+        except OSError as e:
+            print("Cannot write the cache entry in %s: %s" % (self.directory, e))
+            return
+        self.evict(path)
+
+    # Removes the least recently used entries until the cache fits, but keep
+    # (other processes may be removing entries too)
+    def evict(self, keep):
+        entries = list()
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path != keep:
+                remove(path)
+                total -= size
+
+
+# The RoadCaches of the run, by cache directory, file and max_error
+road_caches = dict()
+
+
+# The roads and junctions built from one file and the lane centre lines of the
+# roads, by fingerprint of their <road> or <junction> element, the hash of its
+# XML. A road or junction keeps its fingerprint
+# The entries of the file are the ones of its last conversion: the roads and
+# junctions of the previous version of the file are reused when their element
+# did not change, the other ones are parsed (and sampled) again. The roads and
+# junctions, and the lane lines are two entries, each one written once per
+# conversion
+# The entries are keyed by the path of the file, the sampling and the version
+class RoadCache(object):
+    def __init__(self, cache, filename, max_error):
+        super(RoadCache, self).__init__()
+        self.cache = cache
+        self.roads_path = os.path.join(cache.directory, roads_key(filename, max_error, 'roads') + '.pickle')
+        self.lines_path = os.path.join(cache.directory, roads_key(filename, max_error, 'lines') + '.pickle')
+        # fingerprint: pickled road or junction
+        self.previous_roads = cache.read(self.roads_path) or dict()
+        self.roads = dict()
+        self.roads_changed = False
+
+    # The Road or Junction of the element, parse builds it when it is not cached
+    def record(self, element, parse):
+        fingerprint = hashlib.sha1(etree.tostring(element, with_tail=False)).hexdigest()
+        data = self.previous_roads.get(fingerprint)
+        if data is not None:
+            gc.disable()
+            try:
+                record = pickle.loads(data)
+            finally:
+                gc.enable()
+        else:
+            record = parse(element)
+            # before the model changes it (is_connection, max_arcrad, the converters' way ids)
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            self.roads_changed = True
+        self.roads[fingerprint] = data
+        record.fingerprint = fingerprint
+        return record
+
+    # Only the roads of this version of the file are kept
+    def save_roads(self):
+        if self.roads_changed or len(self.roads) != len(self.previous_roads):
+            self.cache.write(self.roads_path, self.roads)
+        self.previous_roads = self.roads
+        self.roads_changed = False
+
+    # The lane centre lines of all the roads of opendrive, in road order
+    # compute(road_ids) gives the ones of the roads without cached lines
+    def lane_lines(self, opendrive, compute):
+        previous = self.cache.read(self.lines_path) or dict()
+        roads = list(opendrive.roads.values())
+        fingerprints = [getattr(road, 'fingerprint', None) for road in roads]
+        lines = [previous.get(fingerprint) for fingerprint in fingerprints]
+        missing = [index for index, road_lines in enumerate(lines) if road_lines is None]
+        for index, road_lines in zip(missing, compute([roads[index].id for index in missing])):
+            lines[index] = road_lines
+        # a model built without fingerprints has nothing to keep
+        if None not in fingerprints and (missing or len(previous) != len(set(fingerprints))):
+            self.cache.write(self.lines_path, dict(zip(fingerprints, lines)))
+        return lines
+
+
+def model_key(filename, max_error):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    digest.update(repr((max_error, opendrivepy.__version__, pickle.HIGHEST_PROTOCOL)).encode())
+    return digest.hexdigest()
+
+
+def roads_key(filename, max_error, kind):
+    return hashlib.sha256(repr((kind, os.path.abspath(filename), max_error, opendrivepy.__version__,
+                                pickle.HIGHEST_PROTOCOL)).encode()).hexdigest()
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# The model of the file, from the cache when one is given
+def load_opendrive(filename, stream=False, max_error=None, cache=None):
+    if cache is None:
+        return OpenDrive(filename, stream, max_error)
+    return cache.load(filename, stream, max_error)
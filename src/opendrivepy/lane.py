@@ -1,5 +1,7 @@
 from __future__ import division, print_function, absolute_import
 
+import numpy as np
+
 
 class Lanes(object):
     def __init__(self, lane_section_list):
@@ -48,6 +50,14 @@ class LaneSection(object):
             else:
                 return False
 
+    # Widths of the given lanes at ds from the section start, one row per lane,
+    # and the offsets of their inner borders, the widths of the lanes before them
+    def get_lane_widths(self, lanes, ds):
+        widths = np.array([lane.get_widths(ds) for lane in lanes]).reshape(len(lanes), len(ds))
+        offsets = np.zeros(widths.shape)
+        offsets[1:] = np.cumsum(widths[:-1], axis=0)
+        return widths, offsets
+
     def get_left_width(self):
         swidth = 0
         dwidth = 0
@@ -116,6 +126,21 @@ class Lane(object):
             return real_width.get_width(dis)
         return None
 
+    # get_width over an array of distances, the records are found by a binary
+    # search over their s_offset, nan where no record applies
+    def get_widths(self, ds):
+        ds = np.asarray(ds, dtype=float)
+        if not self.width_list:
+            return np.full(len(ds), np.nan)
+        s_offset = np.array([width.s_offset for width in self.width_list])
+        a, b, c, d = np.array([[width.a, width.b, width.c, width.d] for width in self.width_list]).T
+        index = np.searchsorted(s_offset, ds, 'right') - 1
+        valid = index >= 0
+        index = np.maximum(index, 0)
+        ds = ds - s_offset[index]
+        widths = a[index] + b[index]*ds + c[index]*ds**2 + d[index]*ds**3
+        return np.where(valid, widths, np.nan)
+
 
 class LaneLink(object):
     def __init__(self, id):
@@ -1,21 +1,27 @@
 from __future__ import division, print_function, absolute_import
 
+import numpy as np
 
-from opendrivepy.roadmap import RoadMap
+from opendrivepy.roadmap import RoadMap, MATCH_CANDIDATES
+from opendrivepy.projection import Projection
 import opendrivepy.xmlparser
 
 import xml.etree.ElementTree as ET
 from datetime import datetime
 
 class OpenDrive(object):
-    def __init__(self, file):
-        parser = opendrivepy.xmlparser.XMLParser(file)
+    def __init__(self, file, stream=False, max_error=None, road_cache=None):
+        # stream=True builds the model with iterparse and never holds the full DOM
+        # max_error switches the 1 m sampling to adaptive chord-error sampling
+        # road_cache (a cache.RoadCache) gives back the unchanged roads of the file
+        parser = opendrivepy.xmlparser.XMLParser(file, stream, max_error, road_cache)
         self.header = None
         self.roads = parser.parse_roads()
         self.junctions = parser.parse_junctions()
         self.controllers = list()
         # add lon lat
         self.lon,self.lat=parser.parse_lonlat()
+        self.geo_reference = parser.parse_georeference()
         for junc_id, junction in self.junctions.items():
             max_arcrad = 0
             for connection in junction.connections:
@@ -32,5 +38,20 @@ class OpenDrive(object):
         self.stations = list()          # no use for now
         self.roadmap = RoadMap(self.roads)
 
+    # Road id, lane id, s and t of an N x 2 array of points, see RoadMap.match
+    # The points are local x, y, or lon, lat with lonlat, as in the outputs of
+    # the converters
+    def match(self, points, lonlat=False, candidates=MATCH_CANDIDATES, workers=1):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        x, y = points[:, 0], points[:, 1]
+        if lonlat:
+            x, y = self.projection().local_xy(x, y)
+        return self.roadmap.match(x, y, candidates, workers)
+
+    # Projection of the local coordinates to lon, lat and UTM, in the zone of
+    # the origin of the map unless another one is given
+    def projection(self, zone=None):
+        return Projection(self.geo_reference, self.lon, self.lat, zone)
+
 
 
@@ -22,3 +22,65 @@ class EndPoint(Point):
         self.contact_point = contact_point
 
 
+# Struct-of-arrays storage of the sampled points of a road: contiguous float64
+# arrays for s, x, y, heading and z, 40 bytes per sample
+# Indexing or iterating gives PointView objects, for callers that expect Points
+class PointArray(object):
+    def __init__(self, s, x, y, rad, z):
+        self.s = s
+        self.x = x
+        self.y = y
+        self.rad = rad
+        self.z = z
+
+    def __len__(self):
+        return len(self.s)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [PointView(self, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('point index out of range')
+        return PointView(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield PointView(self, i)
+
+
+# A sample of a PointArray, reads (and writes) go to the arrays
+class PointView(object):
+    __slots__ = ('array', 'index')
+
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+
+    @property
+    def s(self):
+        return float(self.array.s[self.index])
+
+    @property
+    def x(self):
+        return float(self.array.x[self.index])
+
+    @property
+    def y(self):
+        return float(self.array.y[self.index])
+
+    @property
+    def rad(self):
+        return float(self.array.rad[self.index])
+
+    @property
+    def z(self):
+        return float(self.array.z[self.index])
+
+    @z.setter
+    def z(self, value):
+        self.array.z[self.index] = value
+
+    def distance(self, other):
+        return sqrt((self.x - other.x) ** 2 + (self.y - other.y) ** 2)
@@ -0,0 +1,83 @@
+from __future__ import division, print_function, absolute_import
+
+import re
+
+import numpy as np
+from pyproj import CRS, Transformer
+from pyproj.exceptions import CRSError
+
+
+# The transformers are built once per pair of CRS and reused for the whole run
+transformers = dict()
+
+
+def get_transformer(source, target):
+    key = (source, target)
+    if key not in transformers:
+        source_crs = CRS(source)
+        target_crs = source_crs.geodetic_crs if target is None else CRS(target)
+        transformers[key] = Transformer.from_crs(source_crs, target_crs, always_xy=True)
+    return transformers[key]
+
+
+def utm_crs(zone, south=False):
+    return '+proj=utm +zone=%d%s +ellps=WGS84' % (zone, ' +south' if south else '')
+
+
+# The UTM zone of a longitude, the 6 degree bands from 180 W
+def utm_zone(lon):
+    return int((lon + 180) // 6) % 60 + 1
+
+
+# The CRS of the local coordinates of a geoReference, None if it has none
+# The grids are dropped: no geoid files come with the maps and they only
+# shift the heights. A bare '+lat_0 +lon_0' is a transverse mercator origin
+def georeference_crs(geo_reference):
+    if not geo_reference or not geo_reference.strip():
+        return None
+    crs = re.sub(r'\+(geoidgrids|nadgrids)=\S+', '', geo_reference).split()
+    crs = ' '.join(crs)
+    if '+proj=' not in crs:
+        if '+lat_0=' not in crs or '+lon_0=' not in crs:
+            return None
+        crs = '+proj=tmerc ' + crs + ' +k=1 +x_0=0 +y_0=0 +datum=WGS84 +units=m'
+    try:
+        CRS(crs)
+    except CRSError:
+        print("Unknown geoReference, using the default origin: " + geo_reference)
+        return None
+    return crs
+
+
+class Projection(object):
+    # Local x, y of an OpenDRIVE map to lon, lat and UTM, on arrays
+    # With a geoReference the local coordinates are in its CRS. Without one
+    # they are offsets from the origin lon, lat on the UTM zone, as the
+    # converters always placed them
+    # The UTM zone and hemisphere are the ones of the origin unless given
+    def __init__(self, geo_reference, lon, lat, zone=None):
+        self.utm = utm_crs(utm_zone(lon) if zone is None else zone, lat < 0)
+        self.crs = georeference_crs(geo_reference)
+        if self.crs is None:
+            self.base_utmx, self.base_utmy = get_transformer(self.utm, None).transform(lon, lat, direction='INVERSE')
+
+    def lonlat(self, x, y):
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        if self.crs is None:
+            return get_transformer(self.utm, None).transform(self.base_utmx + x, self.base_utmy + y)
+        return get_transformer(self.crs, None).transform(x, y)
+
+    # lon, lat back to the local x, y
+    def local_xy(self, lon, lat):
+        lon, lat = np.asarray(lon, dtype=float), np.asarray(lat, dtype=float)
+        if self.crs is None:
+            utmx, utmy = get_transformer(self.utm, None).transform(lon, lat, direction='INVERSE')
+            return utmx - self.base_utmx, utmy - self.base_utmy
+        return get_transformer(self.crs, None).transform(lon, lat, direction='INVERSE')
+
+    def utm_xy(self, x, y):
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        if self.crs is None:
+            return self.base_utmx + x, self.base_utmy + y
+        lon, lat = self.lonlat(x, y)
+        return get_transformer(self.utm, None).transform(lon, lat, direction='INVERSE')
@@ -1,6 +1,11 @@
 from __future__ import division, print_function, absolute_import
 
-from opendrivepy.point import EndPoint
+from math import sqrt, ceil, pi
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from opendrivepy.point import EndPoint, PointArray
 
 
 class Road(object):
@@ -24,55 +29,226 @@ class Road(object):
                 self.style = 'mix'
                 break
 
-        self.points = list()
+        # With adaptive sampling, the records also need samples where the
+        # lanes and the elevation change
+        self.max_error = plan_view[0].max_error
+        if self.max_error is not None:
+            self.refine_plan_view(elevations)
+
         self.arcrad = 0
         # a road is composed by serval plan views
         # TODO: WHY??
         for view in self.plan_view:
             if view.style == 'arc' and view.length > 1e-2 and view.radius > self.arcrad and view.radius < 100:
                 self.arcrad = view.radius
-            for point in view.points:
-                self.points.append(point)
         # print(self.arcrad)
 
         self.elevation_profile = elevations
+        self.lateral_profile = None
+
+    # The sampled road is built on the first access to one of these attributes:
+    # parsing only reads the records, the roads nobody samples cost no more
+    SAMPLED = ('s_array', 'x_array', 'y_array', 'hdg_array', 'z_array', 'elevated',
+               'section_ranges', 'points', 'start_point', 'end_point')
+
+    def __getattr__(self, name):
+        if name not in Road.SAMPLED:
+            raise AttributeError(name)
+        self.sample()
+        return self.__dict__[name]
 
+    def is_sampled(self):
+        return 's_array' in self.__dict__
+
+    def sample_once(self):
+        if not self.is_sampled():
+            self.sample()
+
+    def sample(self):
+        # Points that represent the road, as contiguous arrays
+        # Endpoints between records are duplicated atm
+        self.s_array = np.concatenate([view.s_array for view in self.plan_view])
+        self.x_array = np.concatenate([view.x_array for view in self.plan_view])
+        self.y_array = np.concatenate([view.y_array for view in self.plan_view])
+        self.hdg_array = np.concatenate([view.hdg_array for view in self.plan_view])
+        self.z_array = np.zeros(len(self.s_array))
+        self.share_plan_view_arrays()
+
+        elevations = self.elevation_profile
         points_id = 0
         for i in range(len(elevations)-1):
             elevation = elevations[i]
             if elevation.a != 0 or elevation.b != 0 or elevation.c != 0 or elevation.d != 0: # has banking
-                while points_id < len(self.points):
-                    if self.points[points_id].s >= elevations[i+1].s:
-                        break
-                    
-                    ds = self.points[points_id].s - elevation.s
-                    self.points[points_id].z = elevation.a + elevation.b * ds + elevation.c * (ds**2) + elevation.d * (ds**3)
-                    points_id += 1
-
-
+                # the points from points_id up to the first one at or after the next elevation
+                stop = max(points_id, int(np.searchsorted(self.s_array, elevations[i+1].s)))
+                self.z_array[points_id:stop] = evaluate_elevation(elevation, self.s_array[points_id:stop])
+                points_id = stop
 
         elevation = elevations[-1]
         if elevation.a != 0 or elevation.b != 0 or elevation.c != 0 or elevation.d != 0: # has banking
-            while points_id < len(self.points):                
-                ds = self.points[points_id].s - elevation.s
-                self.points[points_id].z = elevation.a + elevation.b * ds + elevation.c * (ds**2) + elevation.d * (ds**3)
-                points_id += 1
+            self.z_array[points_id:] = evaluate_elevation(elevation, self.s_array[points_id:])
+            points_id = len(self.s_array)
+        # the points before points_id got a height from the elevation profile
+        self.elevated = points_id
 
+        # index range of the points of each lane section
+        self.section_ranges = self.lane_section_ranges()
 
-        self.lateral_profile = None
+        self.sampled_views()
 
-        # Points that represent the road
-        # Endpoints between records are duplicated atm
-        self.points = list()
-        self.generate_points()
+    def sampled_views(self):
+        # view of the arrays for the callers that work on points
+        self.points = PointArray(self.s_array, self.x_array, self.y_array, self.hdg_array, self.z_array)
 
-        self.start_point = EndPoint
-        self.end_point = EndPoint
         self.update_endpoints()
 
-    def generate_points(self):
-        for record in self.plan_view:
-            self.points.extend(record.points)
+    # The samples of the road, for the processes sampling the roads of another
+    # one: the arrays, the lane section ranges and the number of points of
+    # each record
+    def samples(self):
+        self.sample_once()
+        return (self.s_array, self.x_array, self.y_array, self.hdg_array, self.z_array, self.elevated,
+                self.section_ranges, [len(view.s_array) for view in self.plan_view])
+
+    # Takes the samples of the same road made by another process
+    def set_samples(self, samples):
+        (self.s_array, self.x_array, self.y_array, self.hdg_array, self.z_array, self.elevated,
+         self.section_ranges, sizes) = samples
+        self.share_plan_view_arrays(sizes)
+        self.sampled_views()
+
+    # Re-samples the records at the stations required by the lane sections,
+    # the lane widths and the elevation, for the lateral extent of the lanes
+    def refine_plan_view(self, elevations):
+        stations = list()
+        lateral = 0
+        for i, lane_section in enumerate(self.lane_section_list):
+            if i + 1 < len(self.lane_section_list):
+                end = self.lane_section_list[i + 1].s
+            else:
+                end = float(self.length)
+            stations.append(lane_section.s)
+
+            for lanes in (lane_section.left, lane_section.right):
+                side = 0
+                for lane in lanes:
+                    width_list = lane.width_list
+                    max_width = 0
+                    for j, width in enumerate(width_list):
+                        start = lane_section.s + width.s_offset
+                        stop = lane_section.s + width_list[j + 1].s_offset if j + 1 < len(width_list) else end
+                        stations.extend(cubic_stations(start, stop, width, self.max_error))
+                        max_width = max(max_width, cubic_bound(stop - start, width))
+                    side += max_width
+                lateral = max(lateral, side)
+
+        for i, elevation in enumerate(elevations):
+            stop = elevations[i + 1].s if i + 1 < len(elevations) else float(self.length)
+            stations.extend(cubic_stations(elevation.s, stop, elevation, self.max_error))
+
+        for view in self.plan_view:
+            view.refine(stations, lateral)
+
+    # The records keep slices of the road arrays instead of their own copies
+    # sizes are the number of points of each record, the ones they have by default
+    def share_plan_view_arrays(self, sizes=None):
+        if sizes is None:
+            sizes = [len(view.s_array) for view in self.plan_view]
+        start = 0
+        for view, size in zip(self.plan_view, sizes):
+            stop = start + size
+            view.set_coords(self.s_array[start:stop], self.x_array[start:stop],
+                            self.y_array[start:stop], self.hdg_array[start:stop])
+            start = stop
+
+    # The records are pickled without their slices, they get them back once loaded
+    # The road is sampled first, the cached models keep their samples
+    def __getstate__(self):
+        self.sample_once()
+        state = self.__dict__.copy()
+        state['plan_view_sizes'] = [len(view.s_array) for view in self.plan_view]
+        state['plan_view'] = [view.without_coords() for view in self.plan_view]
+        return state
+
+    def __setstate__(self, state):
+        sizes = state.pop('plan_view_sizes')
+        self.__dict__.update(state)
+        self.share_plan_view_arrays(sizes)
+
+    # Index range [start, stop) of the points of each lane section, the points
+    # LaneSection.have_point accepts: s >= section.s and s <= next section s + 1
+    # s can step back by rounding errors where records join, so the starts are
+    # searched in its running max and the stops in its running min from the end
+    def lane_section_ranges(self):
+        rising = np.maximum.accumulate(self.s_array)
+        falling = np.minimum.accumulate(self.s_array[::-1])[::-1]
+        ranges = list()
+        for i, lane_section in enumerate(self.lane_section_list):
+            start = int(np.searchsorted(rising, lane_section.s, 'left'))
+            if i + 1 < len(self.lane_section_list):
+                stop = int(np.searchsorted(falling, self.lane_section_list[i+1].s + 1, 'right'))
+            else:
+                stop = len(self.s_array)
+            ranges.append((start, max(start, stop)))
+        return ranges
+
+    # Centre lines of the lanes of one side of a lane section, over the section's
+    # index range: the lane widths and the x, y of the lane centres, one row per lane
+    def lane_center_lines(self, section_id, side):
+        lane_section = self.lane_section_list[section_id]
+        start, stop = self.section_ranges[section_id]
+        if side == 'left':
+            lanes, normal = lane_section.left, self.hdg_array[start:stop] + pi / 2
+        else:
+            lanes, normal = lane_section.right, self.hdg_array[start:stop] - pi / 2
+        widths, offsets = lane_section.get_lane_widths(lanes, self.s_array[start:stop] - lane_section.s)
+        distance = offsets + (widths / 2)
+        x = self.x_array[start:stop] + np.cos(normal) * distance
+        y = self.y_array[start:stop] + np.sin(normal) * distance
+        return widths, x, y
+
+    # Position and heading of the reference line at the stations s, evaluated
+    # on the records rather than read from the samples
+    # The stations before the first record or after the last one extend them
+    def reference_line(self, s):
+        s = np.asarray(s, dtype=float)
+        x, y, hdg = by_record(self.plan_view, s.reshape(-1), lambda record, ds: record.evaluate(ds), 3)
+        return x.reshape(s.shape), y.reshape(s.shape), hdg.reshape(s.shape)
+
+    # Frenet coordinates to x, y: t is the offset to the left of the reference line
+    def sl_to_xy(self, s, t):
+        s, t = np.broadcast_arrays(np.asarray(s, dtype=float), np.asarray(t, dtype=float))
+        x, y, hdg = self.reference_line(s)
+        return x - np.sin(hdg) * t, y + np.cos(hdg) * t
+
+    # x, y to Frenet coordinates: s starts at the closest sample of the road,
+    # Newton steps then move it where the point is square to the reference line
+    def xy_to_sl(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        shape = x.shape
+        x, y = x.reshape(-1), y.reshape(-1)
+        _, nearest = cKDTree(np.column_stack([self.x_array, self.y_array])).query(np.column_stack([x, y]))
+        s = self.s_array[nearest]
+        end = self.plan_view[-1].s + self.plan_view[-1].length
+        for _ in range(XY_TO_SL_STEPS):
+            ref_x, ref_y, hdg = self.reference_line(s)
+            along = (x - ref_x) * np.cos(hdg) + (y - ref_y) * np.sin(hdg)
+            normal = (y - ref_y) * np.cos(hdg) - (x - ref_x) * np.sin(hdg)
+            curvature, = by_record(self.plan_view, s, lambda record, ds: (record.curvatures(ds),), 1)
+            # the distance to the foot of the point changes with 1 - curvature * t,
+            # a plain step when the point is near the centre of the curvature
+            scale = 1 - curvature * normal
+            step = along / np.where(scale > XY_TO_SL_MIN_SCALE, scale, 1)
+            s = np.clip(s + step, 0, end)
+            if not np.any(np.abs(step) > XY_TO_SL_TOLERANCE):
+                break
+        ref_x, ref_y, hdg = self.reference_line(s)
+        t = (y - ref_y) * np.cos(hdg) - (x - ref_x) * np.sin(hdg)
+        return s.reshape(shape), t.reshape(shape)
+
+    # Heights as python numbers, the points with no elevation keep the int 0 of Point
+    def z_list(self):
+        return self.z_array[:self.elevated].tolist() + [0] * (len(self.z_array) - self.elevated)
 
     def draw_road(self):
         for record in self.plan_view:
@@ -99,6 +275,46 @@ class Road(object):
 
     # WARNING: This only works so far with a fix width. Simplified for testing purposes
 
+# Newton steps of Road.xy_to_sl, and the step (in meter) under which it stops
+XY_TO_SL_STEPS = 8
+XY_TO_SL_TOLERANCE = 1e-9
+XY_TO_SL_MIN_SCALE = 0.1
+
+
+# count arrays of the stations s, each one from the record the station is on:
+# evaluate(record, ds) gives them for the offsets ds of the stations of a record
+def by_record(plan_view, s, evaluate, count):
+    starts = [record.s for record in plan_view]
+    index = np.clip(np.searchsorted(starts, s, 'right') - 1, 0, len(plan_view) - 1)
+    values = [np.empty(len(s)) for _ in range(count)]
+    for i in np.unique(index):
+        rows = index == i
+        record = plan_view[i]
+        for value, result in zip(values, evaluate(record, s[rows] - record.s)):
+            value[rows] = result
+    return values
+
+
+def evaluate_elevation(elevation, s):
+    ds = s - elevation.s
+    return elevation.a + elevation.b * ds + elevation.c * (ds**2) + elevation.d * (ds**3)
+
+
+# Stations on [start, stop) such that the chords of the cubic a + b*ds + c*ds^2
+# + d*ds^3 stay within max_error, from the bound of its second derivative
+def cubic_stations(start, stop, poly, max_error):
+    curvature = max(abs(2 * poly.c), abs(2 * poly.c + 6 * poly.d * (stop - start)))
+    if curvature == 0 or stop <= start:
+        return [start]
+    n = int(ceil((stop - start) / sqrt(8 * max_error / curvature)))
+    return np.linspace(start, stop, n + 1)[:-1].tolist()
+
+
+# Upper bound of |a + b*ds + c*ds^2 + d*ds^3| on [0, length]
+def cubic_bound(length, poly):
+    return abs(poly.a) + abs(poly.b) * length + abs(poly.c) * length ** 2 + abs(poly.d) * length ** 3
+
+
 class RoadLink(object):
     def __init__(self, element_type, element_id, contact_point):
         self.element_type = element_type
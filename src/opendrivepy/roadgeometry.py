@@ -1,5 +1,8 @@
 from __future__ import division, print_function, absolute_import
 
+import copy
+from abc import ABC, abstractmethod
+
 import numpy as np
 from scipy.special import fresnel
 from matplotlib import pyplot as plt
@@ -7,8 +10,10 @@ from math import pi, sin, cos, sqrt, fabs, ceil
 
 from opendrivepy.point import Point
 
-class RoadGeometry(object):
-    def __init__(self, s, x, y, hdg, length, style):
+# A geometry record of the plan view, the record types implement evaluate and
+# cannot be built without it
+class RoadGeometry(ABC):
+    def __init__(self, s, x, y, hdg, length, style, max_error=None):
         self.s = s
         self.x = x
         self.y = y
@@ -16,7 +21,106 @@ class RoadGeometry(object):
         self.length = length
 
         self.style = style        
-        self.points = list()
+
+        # Sampling: every metre when max_error is None, otherwise as few samples
+        # as possible while the chords stay within max_error of the curve at
+        # a lateral distance up to self.lateral from the reference line
+        self.max_error = max_error
+        self.lateral = 0
+        self.stations = list()
+
+        # Sampled s/x/y/heading of the record, filled by generate_coords on the
+        # first access to them, so that the records of the roads nobody looks
+        # at are never sampled
+        self._coords = None
+        self._points = None
+
+    @property
+    def s_array(self):
+        return self.coords()[0]
+
+    @property
+    def x_array(self):
+        return self.coords()[1]
+
+    @property
+    def y_array(self):
+        return self.coords()[2]
+
+    @property
+    def hdg_array(self):
+        return self.coords()[3]
+
+    def coords(self):
+        if self._coords is None:
+            self.generate_coords()
+        return self._coords
+
+    # Points are only built from the sampled arrays when someone asks for them
+    @property
+    def points(self):
+        if self._points is None:
+            self._points = [Point(x, y, s, hdg) for s, x, y, hdg in zip(
+                self.s_array.tolist(), self.x_array.tolist(), self.y_array.tolist(), self.hdg_array.tolist())]
+        return self._points
+
+    # Local offsets of the samples: every metre, plus the end of the record
+    def sample_offsets(self):
+        if self.max_error is not None:
+            return self.adaptive_offsets()
+        array = np.arange(0, int(ceil(self.length)+1), dtype=float)
+        array[-1] = self.length
+        return array
+
+    # Evenly spread offsets, the chord error of a step ds on a curvature k seen
+    # at the lateral distance w is about ds^2 * k * (1 + k * w) / 8
+    def adaptive_offsets(self):
+        curvature = self.max_curvature()
+        curvature *= 1 + curvature * self.lateral
+        n = 1
+        if curvature > 0:
+            n = max(1, int(ceil(self.length / sqrt(8 * self.max_error / curvature))))
+        array = np.linspace(0, self.length, n + 1)
+
+        # extra stations (lane sections, lane widths...) required by the road
+        stations = [station - self.s for station in self.stations if self.s < station < self.s + self.length]
+        if stations:
+            array = np.union1d(array, stations)
+        return array
+
+    def max_curvature(self):
+        return 0
+
+    # Re-samples the record with the stations and the lateral extent of its road
+    def refine(self, stations, lateral):
+        self.stations = stations
+        self.lateral = lateral
+        self.set_coords(None, None, None, None)
+
+    # Position and heading at the local offsets ds of the record
+    @abstractmethod
+    def evaluate(self, ds):
+        pass
+
+    # Curvature at the local offsets ds of the record
+    def curvatures(self, ds):
+        return np.zeros(len(ds))
+
+    def generate_coords(self):
+        array = self.sample_offsets()
+        x, y, hdg = self.evaluate(array)
+        self.set_coords(self.s + array, x, y, hdg)
+
+    # None drops the samples, the next access samples the record again
+    def set_coords(self, s, x, y, hdg):
+        self._coords = (s, x, y, hdg) if s is not None else None
+        self._points = None
+
+    # A copy of the record without its sampled arrays
+    def without_coords(self):
+        record = copy.copy(self)
+        record.set_coords(None, None, None, None)
+        return record
 
 class RoadElevation(object):
     def __init__(self, s, a, b, c, d):
@@ -27,9 +131,8 @@ class RoadElevation(object):
         self.d = d
 
 class RoadLine(RoadGeometry):
-    def __init__(self, s, x, y, hdg, length):
-        super(RoadLine, self).__init__(s, x, y, hdg, length, style='line')
-        self.generate_coords()
+    def __init__(self, s, x, y, hdg, length, max_error=None):
+        super(RoadLine, self).__init__(s, x, y, hdg, length, 'line', max_error)
 
     '''
     y
@@ -38,76 +141,92 @@ class RoadLine(RoadGeometry):
     /)_____  x
 
     '''
-    def generate_coords(self):
-        # for n in range(0, int(ceil(self.length) + 1)):
-        array=[n for n in range(0, int(ceil(self.length)+1))]
-        array[-1]=self.length
-        for n in array:
-            x = self.x + (n * cos(self.hdg))
-            y = self.y + (n * sin(self.hdg))
-            self.points.append(Point(x, y, self.s + n, self.hdg))
+    def evaluate(self, ds):
+        x = self.x + (ds * cos(self.hdg))
+        y = self.y + (ds * sin(self.hdg))
+        return x, y, np.full(len(ds), self.hdg)
         
 
 class RoadArc(RoadGeometry):
-    def __init__(self, s, x, y, hdg, length, curvature):
-        super(RoadArc, self).__init__(s, x, y, hdg, length, 'arc')
+    def __init__(self, s, x, y, hdg, length, curvature, max_error=None):
+        super(RoadArc, self).__init__(s, x, y, hdg, length, 'arc', max_error)
         self.curvature = curvature
         self.radius = fabs(1/self.curvature)
-        self.generate_coords()
+
+    def max_curvature(self):
+        return fabs(self.curvature)
+
+    def curvatures(self, ds):
+        return np.full(len(ds), self.curvature)
+
+    # the centre of the circle and the angle from it to the start of the arc
+    def base_circle(self):
+        # If curvature > 0, then the arc rotates anticlockwise
+        if self.curvature > 0:
+            start_angle = self.hdg + (pi / 2)   # from x to centre of circle
+        # Otherwise it is clockwise
+        else:
+            start_angle = self.hdg - (pi / 2)
+        circlex = self.x + (cos(start_angle) * self.radius)
+        circley = self.y + (sin(start_angle) * self.radius)
+        return circlex, circley, start_angle
 
     def base_arc(self):
         n=int(ceil(self.length)+1)
         radius = self.radius
         circumference = radius * pi * 2 # 2 pi r
         angle = self.length / radius    # absolutely positive
-        # If curvature > 0, then the arc rotates anticlockwise
+        circlex, circley, start_angle = self.base_circle()
+        array = self.sample_offsets()   # from 0 to n-1, the last one is the length
+        # the angles are evenly spread over the n samples
+        index = np.arange(n, dtype=float)
         if self.curvature > 0:
-            # the centre of a circle
-            start_angle = self.hdg + (pi / 2)   # from x to centre of circle
-            circlex = self.x + (cos(start_angle) * radius)
-            circley = self.y + (sin(start_angle) * radius)
-
-            array = list(range(n))  # from 0 to n-1
-            angle_list=[start_angle - pi + (angle * x / (n-1)) for x in array]
-            angle_list[-1]=start_angle - pi+angle
-            array[-1]=self.length
-            return radius, circlex, circley, angle_list, array
-            
-        # Otherwise it is clockwise
+            angle_list = start_angle - pi + (angle * index / (n-1))
+            angle_list[-1] = start_angle - pi+angle
         else:
-            start_angle = self.hdg - (pi / 2)
-            circlex = self.x + (cos(start_angle) * radius)
-            circley = self.y + (sin(start_angle) * radius)
-            array = list(range(n))
-            angle_list=[start_angle + pi - (angle * x / (n-1)) for x in array]
-            angle_list[-1]=start_angle + pi-angle
-            array[-1]=self.length
-            return radius, circlex, circley, angle_list, array
+            angle_list = start_angle + pi - (angle * index / (n-1))
+            angle_list[-1] = start_angle + pi-angle
+        return radius, circlex, circley, angle_list, array
+
+    def evaluate(self, ds):
+        circlex, circley, start_angle = self.base_circle()
+        if self.curvature > 0:
+            angles = start_angle - pi + ds / self.radius
+        else:
+            angles = start_angle + pi - ds / self.radius
+        return self.arc_coords(circlex, circley, angles)
+
+    def arc_coords(self, circle_x, circle_y, angles):
+        x = circle_x + (self.radius * np.cos(angles))
+        y = circle_y + (self.radius * np.sin(angles))
+        if self.curvature > 0:
+            return x, y, angles + pi / 2
+        return x, y, angles - pi / 2
 
     def generate_coords(self):
+        if self.max_error is not None:
+            return super(RoadArc, self).generate_coords()
 
         r, circle_x, circle_y, angles, array = self.base_arc()
-
-        for n, s in zip(angles, array):
-            x = circle_x + (r * cos(n))
-            y = circle_y + (r * sin(n))
-            
-            if self.curvature > 0:
-                self.points.append(Point(x, y, self.s + s, n + pi / 2))
-            else:
-                self.points.append(Point(x, y, self.s + s, n - pi / 2))
+        x, y, hdg = self.arc_coords(circle_x, circle_y, angles)
+        self.set_coords(self.s + array, x, y, hdg)
         
 class RoadSpiral(RoadGeometry):
-    def __init__(self, s, x, y, hdg, length, curvstart, curvend):
-        super(RoadSpiral, self).__init__(s, x, y, hdg, length, 'spiral')
+    def __init__(self, s, x, y, hdg, length, curvstart, curvend, max_error=None):
+        super(RoadSpiral, self).__init__(s, x, y, hdg, length, 'spiral', max_error)
         self.curvStart = curvstart
         self.curvEnd = curvend
         self.cDot = (curvend-curvstart)/length
         self.spiralS = curvstart/self.cDot
-        # self.generate_coords(int(ceil(self.length) + 1))
-        self.generate_coords()
 
-    # Approximates the standard Euler spiral at a point length s along the curve
+    def max_curvature(self):
+        return max(fabs(self.curvStart), fabs(self.curvEnd))
+
+    def curvatures(self, ds):
+        return self.curvStart + self.cDot * ds
+
+    # Approximates the standard Euler spiral at the lengths s along the curve
+    # s may be an array, fresnel is then evaluated for all of them in one call
     def odr_spiral(self, s):
         a = 1 / sqrt(fabs(self.cDot))
         a *= sqrt(pi)
@@ -123,61 +242,26 @@ class RoadSpiral(RoadGeometry):
         t = s * s * self.cDot * 0.5
         return x, y, t
 
-    # Approximates a piece of the standard Euler spiral using n points
-    # The spiral is adjusted such that it stars along x=0
-    def base_spiral(self):
+    # Approximates a piece of the standard Euler spiral at the local offsets ds
+    # Returns the offsets from the start of the piece and the start tangent angle
+    def base_spiral(self, ds):
 
         ox, oy, theta = self.odr_spiral(self.spiralS)
-        sin_rot = sin(theta)
-        cos_rot = cos(theta)
-        xcoords = list()
-        ycoords = list()
-        scoords=list()
-        array=[n for n in range(0, int(ceil(self.length)+1))]
-        array[-1]=self.length
-        for i in array:
-            tx, ty, ttheta = self.odr_spiral(i + self.spiralS)
-            
-            dx = tx - ox
-            dy = ty - oy
-            xcoords.append(dx * cos_rot + dy * sin_rot)
-            ycoords.append(dy * cos_rot - dx * sin_rot)
-            tx, ty, ttheta = self.odr_spiral(i  + self.spiralS+pi/180)
-            scoords.append(i)
-            
-            dx = tx - ox
-            dy = ty - oy
-            xcoords.append(dx * cos_rot + dy * sin_rot)
-            ycoords.append(dy * cos_rot - dx * sin_rot)
-            scoords.append(i)
-
-        return xcoords, ycoords,scoords
-
-    def evaluate_spiral(self, n):
-        xarr, yarr,sarr= self.base_spiral()
-        sinRot = sin(self.hdg)
-        cosRot = cos(self.hdg)
-        for i in range(2*n):
-            tmpX = self.x + cosRot * xarr[i] - sinRot * yarr[i]
-            tmpY = self.y + cosRot * yarr[i] + sinRot * xarr[i]
-            xarr[i] = tmpX
-            yarr[i] = tmpY
-
-        return xarr, yarr,sarr
+        tx, ty, ttheta = self.odr_spiral(ds + self.spiralS)
 
-    def generate_coords(self):
-        n=int(ceil(self.length)+1)
-        xarr, yarr,sarr = self.evaluate_spiral(n)
-        angle=0
-        # angle_arr.append(0)
-        for i in range(0,2*n,2):
-            # if i<n-1:
-            #     angle=np.arctan2(yarr[i+1]-yarr[i-1], xarr[i+1]-xarr[i-1])
-            angle=np.arctan2(yarr[i+1]-yarr[i],(xarr[i+1]-xarr[i]))
-            # if self.cDot < 0:
-            #       angle=angle+pi
-            self.points.append(Point(xarr[i], yarr[i], self.s+sarr[i],angle))
-            # angle_arr.append(angle)
-        # angle_arr[0]=angle_arr[1]
-        # for i in range(n):
-        #     self.points.append(Point(xarr[i*2], yarr[i*2], i,angle_arr[i]))
+        return tx - ox, ty - oy, theta
+
+    def evaluate(self, ds):
+        dx, dy, theta = self.base_spiral(ds)
+
+        # Rotate the piece such that it starts along x=0, then along the heading
+        sinRot = sin(self.hdg - theta)
+        cosRot = cos(self.hdg - theta)
+        x = self.x + cosRot * dx - sinRot * dy
+        y = self.y + cosRot * dy + sinRot * dx
+
+        # The heading is the integral of the linear curvature along the spiral
+        hdg = self.hdg + self.curvStart * ds + 0.5 * self.cDot * ds * ds
+        hdg = (hdg + pi) % (2 * pi) - pi
+
+        return x, y, hdg
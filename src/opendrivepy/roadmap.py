@@ -1,47 +1,60 @@
 from __future__ import division, print_function, absolute_import
 
+import numpy as np
+from scipy.spatial import cKDTree
+
+from opendrivepy.rtree import STRTree
+
+# Default number of closest match points of which the lane segments are tried
+# (RoadMap.match and OpenDrive.match)
+MATCH_CANDIDATES = 8
+
 
 class RoadMap(object):
+    # The segments between the samples of the reference lines, each with the
+    # width of the road on its left and on its right, in an STR packed R-tree of
+    # their boxes grown by these widths. A point is on a road when it is within
+    # the width of the road on its side of a segment
+    # The tree is built on the first query, the roads are sampled then
+    # Map matching looks for the lane centre lines in a KD-tree of points
+    # along them, built on the first match, the lanes in a box in an R-tree of
+    # the lane segments
     def __init__(self, roads):
         self.roads = roads
+        self.tree = None
+        self.match_tree = None
+        self.lane_tree = None
 
-    # Finds the closest point on the roads to the given point
+    def build(self):
+        road_list = list()
+        columns = list()
+        for road in self.roads.values():
+            if len(road.s_array) < 2:
+                continue
+            left, right = road_widths(road)
+            count = len(road.s_array) - 1
+            columns.append((np.full(count, len(road_list)), np.arange(count),
+                            road.x_array[:-1], road.y_array[:-1], road.x_array[1:], road.y_array[1:],
+                            np.maximum(left[:-1], left[1:]), np.maximum(right[:-1], right[1:])))
+            road_list.append(road)
+        self.road_list = road_list
+        if columns:
+            columns = [np.concatenate(column) for column in zip(*columns)]
+        else:
+            columns = [np.zeros(0, dtype=int)] * 2 + [np.zeros(0)] * 6
+        self.road_index, self.point_index, self.x1, self.y1, self.x2, self.y2, self.left, self.right = columns
+        reach = np.maximum(self.left, self.right)
+        self.tree = STRTree(np.column_stack([np.minimum(self.x1, self.x2) - reach, np.minimum(self.y1, self.y2) - reach,
+                                             np.maximum(self.x1, self.x2) + reach, np.maximum(self.y1, self.y2) + reach]))
+
+    # Finds the closest segment of the roads to the given point, among the ones
+    # the point is on the road of, and the widths of the road at this segment
     def closest_point(self, q):
-        min_dist = 100
-        min_segment = None
-        road_left = 0
-        road_right = 0
-
-        roads = self.roads
-        for road in roads.values():
-            # if road.in_range(q) is False:
-            #     continue
-            left = road.get_left_width(0)
-            right = road.get_right_width(0)
-            for segment in road.segments:
-                if segment.min_distance(q) < min_dist and self.in_range(segment, q, left, right, segment.min_distance(q)):
-                    min_segment = segment
-                    min_dist = segment.min_distance(q)
-                    road_left = left
-                    road_right = right
-                    print(road.id)
-
-        return min_segment, road_right, road_left
-
-    # Returns the orientation of the point with respect to the line formed by s and e
-    # 1 if the point is left of the line looking at e from s, -1 on the right and 0 on the line
-    def side(self, s, e, q):
-        dotperp = ((e.x - s.x) * (q.y - s.y)) - ((e.y - s.y) * (q.x - s.x))
-        return bool(dotperp > 0) - bool(dotperp < 0)
-
-    def in_range(self, segment, q, left, right, dist):
-        side = self.side(segment.p1, segment.p2, q)
-        if side == 0:  # on the line
-            return True
-        elif side == 1:  # left
-            return dist <= left
-        else:  # right
-            return dist <= right
+        segments, _ = self.closest_segments([q.x], [q.y])
+        if segments[0] < 0:
+            return None, 0, 0
+        segment = segments[0]
+        return self.segment(segment), float(self.right[segment]), float(self.left[segment])
 
     def is_on_road(self, q):
         min_segment, right, left = self.closest_point(q)
@@ -49,3 +62,249 @@ class RoadMap(object):
             return True
         return False
 
+    # closest_point for arrays of points: the index of the closest segment of
+    # each point, -1 off the roads, and the distance to it
+    def closest_segments(self, x, y):
+        if self.tree is None:
+            self.build()
+        x = np.asarray(x, dtype=float).reshape(-1)
+        y = np.asarray(y, dtype=float).reshape(-1)
+        queries, segments = self.tree.contains(x, y)
+        distance, side = segment_distance(self.x1[segments], self.y1[segments], self.x2[segments], self.y2[segments],
+                                          x[queries], y[queries])
+        # on the line (or beyond the end of it) either side will do
+        left, right = self.left[segments], self.right[segments]
+        width = np.where(side > 0, left, np.where(side < 0, right, np.maximum(left, right)))
+        on_road = distance <= width
+        queries, segments, distance = queries[on_road], segments[on_road], distance[on_road]
+
+        # the pairs of a query follow each other, the first one at the least distance
+        group = first_of_groups(queries)
+        least = np.minimum.reduceat(distance, np.flatnonzero(group)) if len(queries) else distance
+        nearest = np.flatnonzero(distance == np.repeat(least, np.diff(np.append(np.flatnonzero(group), len(queries)))))
+        nearest = nearest[first_of_groups(queries[nearest])]
+        closest = np.full(len(x), -1)
+        closest_distance = np.full(len(x), np.inf)
+        closest[queries[nearest]] = segments[nearest]
+        closest_distance[queries[nearest]] = distance[nearest]
+        return closest, closest_distance
+
+    def on_roads(self, x, y):
+        return self.closest_segments(x, y)[0] >= 0
+
+    # The segments of the centre lines of the lanes, the LANE_COLUMNS of each one
+    # A last segment that matches nothing stands for the missing neighbours of
+    # the KD-tree queries
+    def build_lane_segments(self):
+        self.match_roads = list(self.roads.values())
+        columns = list()
+        lines = 0
+        for road_index, road in enumerate(self.match_roads):
+            for section_id, lane_section in enumerate(road.lane_section_list):
+                start, stop = road.section_ranges[section_id]
+                if stop - start < 2:
+                    continue
+                for side, lanes, sign in (('left', lane_section.left, 1), ('right', lane_section.right, -1)):
+                    if not lanes:
+                        continue
+                    widths, x, y = road.lane_center_lines(section_id, side)
+                    widths = np.nan_to_num(widths)
+                    offsets = sign * (np.cumsum(widths, axis=0) - widths / 2)
+                    s = np.broadcast_to(road.s_array[start:stop], x.shape)
+                    count = x[:, 1:].size
+                    columns.append((np.full(count, road_index),
+                                    np.repeat([lane.id for lane in lanes], stop - start - 1),
+                                    np.repeat(np.arange(lines, lines + len(lanes)), stop - start - 1),
+                                    x[:, :-1].ravel(), y[:, :-1].ravel(), x[:, 1:].ravel(), y[:, 1:].ravel(),
+                                    s[:, :-1].ravel(), s[:, 1:].ravel(), widths[:, :-1].ravel() / 2,
+                                    widths[:, 1:].ravel() / 2, offsets[:, :-1].ravel(), offsets[:, 1:].ravel(),
+                                    np.repeat(s[:, 0], stop - start - 1), np.repeat(s[:, -1], stop - start - 1)))
+                    lines += len(lanes)
+        columns.append((np.zeros(1, dtype=int), np.zeros(1, dtype=int), np.full(1, -1)) + (np.zeros(1),) * 6 + (np.full(1, -1.0),) * 2 +
+                       (np.zeros(1),) * 4)
+        self.lanes = dict(zip(LANE_COLUMNS, [np.concatenate(column) for column in zip(*columns)]))
+
+    # The columns of the lane segments, for an array of segments
+    def lane_columns(self, segments, *names):
+        return [self.lanes[name][segments] for name in names]
+
+    # Points every MATCH_STEP metres along the lane segments, each one with its segment
+    def build_match_tree(self):
+        self.build_lane_segments()
+        x1, y1, x2, y2 = [self.lanes[name] for name in ('x1', 'y1', 'x2', 'y2')]
+        length = np.hypot(x2 - x1, y2 - y1)[:-1]
+        pieces = np.maximum(1, np.ceil(length / MATCH_STEP)).astype(int)
+        segments = np.repeat(np.arange(len(pieces)), pieces)
+        # the middles of the pieces of each segment
+        ratio = (np.arange(len(segments)) - np.repeat(np.cumsum(pieces) - pieces, pieces) + 0.5) / np.repeat(pieces, pieces)
+        # the missing neighbours of the queries are given as n, they go to the last segment
+        self.match_segments = np.append(segments, len(pieces))
+        self.match_road_ids = np.array([road.id for road in self.match_roads], dtype=object)
+        self.match_tree = cKDTree(np.column_stack([x1[segments] + ratio * (x2[segments] - x1[segments]),
+                                                   y1[segments] + ratio * (y2[segments] - y1[segments])]))
+        # a point in a lane is within half a width of a segment, and half a
+        # step more of one of its points
+        half_width = np.maximum(self.lanes['half_width1'], self.lanes['half_width2'])
+        self.match_bound = max(0, half_width.max()) + MATCH_STEP / 2
+
+    # Map matching of arrays of points: the road id, lane id, s and lateral
+    # offset t (positive on the left) of each point, None, 0, nan and nan off
+    # the lanes
+    # The lane segments of the candidates closest points along them are the
+    # ones tried, the point is matched to the closest one it is in the lane of
+    # workers is the number of threads of the KD-tree queries, -1 for all
+    def match(self, x, y, candidates=MATCH_CANDIDATES, workers=1):
+        if self.match_tree is None:
+            self.build_match_tree()
+        x = np.asarray(x, dtype=float).reshape(-1)
+        y = np.asarray(y, dtype=float).reshape(-1)
+        road_ids = np.full(len(x), None, dtype=object)
+        lane_ids = np.zeros(len(x), dtype=int)
+        s = np.full(len(x), np.nan)
+        t = np.full(len(x), np.nan)
+        candidates = min(candidates, self.match_tree.n)
+        if len(x) == 0 or candidates == 0:
+            return road_ids, lane_ids, s, t
+
+        _, pieces = self.match_tree.query(np.column_stack([x, y]), candidates, distance_upper_bound=self.match_bound,
+                                          workers=workers)
+        segments = self.match_segments[pieces.reshape(len(x), candidates)]
+        rows = np.arange(len(x))
+        segments = self.closest_lane_segments(segments, x[:, None], y[:, None])
+        matched = segments >= 0
+        rows, segments = rows[matched], segments[matched]
+
+        # the closest segment of a lane is next to the one found, when the point
+        # is past its ends
+        for _ in range(MATCH_REFINE):
+            s1, s2, start, end = self.lane_columns(segments, 's1', 's2', 'start', 'end')
+            around = np.column_stack([np.where(s1 > start, segments - 1, segments), segments,
+                                      np.where(s2 < end, segments + 1, segments)])
+            closest = self.closest_lane_segments(around, x[rows, None], y[rows, None])
+            if np.array_equal(closest, segments):
+                break
+            segments = closest
+
+        road_index, lane_id, x1, y1, x2, y2, s1, s2, t1, t2 = self.lane_columns(
+            segments, 'road', 'lane', 'x1', 'y1', 'x2', 'y2', 's1', 's2', 't1', 't2')
+        _, _, ratio = segment_projection(x1, y1, x2, y2, x[rows], y[rows])
+        s[rows] = s1 + ratio * (s2 - s1)
+        # the offset of the lane centre and the one of the point from the segment line
+        dx, dy = x2 - x1, y2 - y1
+        length = np.hypot(dx, dy)
+        normal = (dx * (y[rows] - y1) - dy * (x[rows] - x1)) / np.where(length > 0, length, 1)
+        t[rows] = t1 + ratio * (t2 - t1) + normal
+        lane_ids[rows] = lane_id
+        road_ids[rows] = self.match_road_ids[road_index]
+        return road_ids, lane_ids, s, t
+
+    # The closest of each row of lane segments the point of the row is in the
+    # lane of, -1 if it is in none of them
+    def closest_lane_segments(self, segments, x, y):
+        x1, y1, x2, y2, s1, s2, half_width1, half_width2, start, end = self.lane_columns(
+            segments, 'x1', 'y1', 'x2', 'y2', 's1', 's2', 'half_width1', 'half_width2', 'start', 'end')
+        distance, _, ratio = segment_projection(x1, y1, x2, y2, x, y)
+        # the points before the start or after the end of a lane are not in it,
+        # the s of the foot of the point on the line of the segment tells
+        dx, dy = x2 - x1, y2 - y1
+        length = dx * dx + dy * dy
+        foot = s1 + ((x - x1) * dx + (y - y1) * dy) / np.where(length > 0, length, 1) * (s2 - s1)
+        inside = (distance <= half_width1 + ratio * (half_width2 - half_width1)) & (foot >= start) & (foot <= end)
+        distance = np.where(inside, distance, np.inf)
+        best = np.argmin(distance, axis=1)
+        rows = np.arange(len(segments))
+        return np.where(np.isfinite(distance[rows, best]), segments[rows, best], -1)
+
+    # The segments of the lanes grown by their half widths, in an R-tree
+    def build_lane_tree(self):
+        if self.match_tree is None:
+            self.build_match_tree()
+        x1, y1, x2, y2, half_width1, half_width2 = [self.lanes[name][:-1] for name in
+                                                    ('x1', 'y1', 'x2', 'y2', 'half_width1', 'half_width2')]
+        reach = np.maximum(half_width1, half_width2)
+        self.lane_tree = STRTree(np.column_stack([np.minimum(x1, x2) - reach, np.minimum(y1, y2) - reach,
+                                                  np.maximum(x1, x2) + reach, np.maximum(y1, y2) + reach]))
+
+    # The pieces of the centre lines of the lanes (of a lane section) that reach
+    # into the box x1, y1, x2, y2, from the first to the last of their segments
+    # in it, as (road id, lane id, s, x, y) with the arrays of their points
+    def lanes_in_box(self, x1, y1, x2, y2):
+        if self.lane_tree is None:
+            self.build_lane_tree()
+        segments = np.sort(self.lane_tree.intersects(x1, y1, x2, y2))
+        lines = self.lanes['line'][segments]
+        first = first_of_groups(lines)
+        last = np.roll(first, -1)
+        found = list()
+        for start, stop in zip(segments[first].tolist(), (segments[last] + 1).tolist()):
+            s, x, y = [np.append(self.lanes[begin][start:stop], self.lanes[end][stop - 1])
+                       for begin, end in (('s1', 's2'), ('x1', 'x2'), ('y1', 'y2'))]
+            found.append((self.match_road_ids[self.lanes['road'][start]], int(self.lanes['lane'][start]), s, x, y))
+        return found
+
+    def segment(self, index):
+        return Segment(self.road_list[self.road_index[index]], int(self.point_index[index]))
+
+
+# Spacing of the points of the map matching KD-tree along the segments
+MATCH_STEP = 1.0
+
+# Steps of the search of the closest segment of a lane along it
+MATCH_REFINE = 4
+
+# The lane segments: the road (index of RoadMap.match_roads) and lane id, the
+# centre line of the lane section they are on (the segments of a line follow
+# each other), the ends, their s, the half widths and lateral offsets t of the lane centre there,
+# and the s at the start and at the end of the lane
+LANE_COLUMNS = ('road', 'lane', 'line', 'x1', 'y1', 'x2', 'y2', 's1', 's2', 'half_width1', 'half_width2', 't1', 't2',
+                'start', 'end')
+
+
+class Segment(object):
+    # The segment of a road between its samples index and index + 1
+    def __init__(self, road, index):
+        self.road = road
+        self.index = index
+        self.p1 = road.points[index]
+        self.p2 = road.points[index + 1]
+
+    def min_distance(self, q):
+        return float(segment_distance(self.p1.x, self.p1.y, self.p2.x, self.p2.y, q.x, q.y)[0])
+
+
+# Width of the lanes on the left and on the right of the reference line of a
+# road at each of its samples
+def road_widths(road):
+    left = np.zeros(len(road.s_array))
+    right = np.zeros(len(road.s_array))
+    for lane_section, (start, stop) in zip(road.lane_section_list, road.section_ranges):
+        ds = road.s_array[start:stop] - lane_section.s
+        for lanes, widths in ((lane_section.left, left), (lane_section.right, right)):
+            lane_widths, _ = lane_section.get_lane_widths(lanes, ds)
+            widths[start:stop] = np.nansum(lane_widths, axis=0)
+    return left, right
+
+
+# True at the first of each run of equal values
+def first_of_groups(values):
+    first = np.ones(len(values), dtype=bool)
+    first[1:] = values[1:] != values[:-1]
+    return first
+
+
+# Distance from the points (x, y) to the segments (x1, y1) - (x2, y2), and the
+# side of the points: 1 on the left looking at the end from the start, -1 on
+# the right and 0 on the line
+def segment_distance(x1, y1, x2, y2, x, y):
+    distance, side, _ = segment_projection(x1, y1, x2, y2, x, y)
+    return distance, side
+
+
+# segment_distance, and the ratio along the segment of the closest point
+def segment_projection(x1, y1, x2, y2, x, y):
+    dx = x2 - x1
+    dy = y2 - y1
+    length = dx * dx + dy * dy
+    t = np.clip(((x - x1) * dx + (y - y1) * dy) / np.where(length > 0, length, 1), 0, 1)
+    distance = np.hypot(x1 + t * dx - x, y1 + t * dy - y)
+    return distance, np.sign(dx * (y - y1) - dy * (x - x1)), t
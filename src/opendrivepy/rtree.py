@@ -0,0 +1,101 @@
+from __future__ import division, print_function, absolute_import
+
+from math import ceil, sqrt
+
+import numpy as np
+
+
+class STRTree(object):
+    """Static R-tree of boxes, packed with the Sort-Tile-Recursive algorithm"""
+
+    # The boxes are (x1, y1, x2, y2) rows, x1 <= x2 and y1 <= y2
+    # Each level is sorted by STR: in slabs of the x of the box centres, then by
+    # their y in each slab, and cut in nodes of capacity entries. The children of
+    # a node are the capacity entries from first[node] on in the level below,
+    # the levels are filled up with empty boxes to a multiple of capacity
+    # The bottom level holds the boxes themselves, items[i] is the index of the
+    # i-th one in the boxes given to the constructor
+    # The levels are (x1, y1, x2, y2 columns, first) pairs, from the root down,
+    # the root level being the children of a single node
+    def __init__(self, boxes, capacity=16):
+        super(STRTree, self).__init__()
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        self.capacity = capacity
+        self.items = str_order(boxes, capacity)
+        level = boxes[self.items]
+        first = None
+        self.levels = list()
+        while True:
+            self.levels.append((columns(level, capacity), first))
+            if len(level) <= capacity:
+                break
+            starts = np.arange(0, len(level), capacity)
+            nodes = np.column_stack([np.minimum.reduceat(level[:, 0], starts), np.minimum.reduceat(level[:, 1], starts),
+                                     np.maximum.reduceat(level[:, 2], starts), np.maximum.reduceat(level[:, 3], starts)])
+            # the nodes are sorted for the level above, their children stay put
+            order = str_order(nodes, capacity)
+            level = nodes[order]
+            first = starts[order]
+        self.levels.reverse()
+
+    def __len__(self):
+        return len(self.items)
+
+    # The (query, item) pairs of the points (x, y) inside the boxes, for arrays
+    # of points: every level is searched for all the queries at once, the
+    # pairs come sorted by query
+    def contains(self, x, y):
+        x = np.asarray(x, dtype=float).reshape(-1)
+        y = np.asarray(y, dtype=float).reshape(-1)
+        children = np.arange(self.capacity)
+        queries = np.arange(len(x))
+        starts = np.zeros(len(x), dtype=int)
+        for boxes, first in self.levels:
+            # one row of capacity children per (query, node) pair
+            nodes = starts[:, None] + children
+            inside = box_contains(boxes, nodes, x[queries][:, None], y[queries][:, None])
+            queries = np.broadcast_to(queries[:, None], nodes.shape)[inside]
+            nodes = nodes[inside]
+            if first is not None:
+                starts = first[nodes]
+        return queries, self.items[nodes]
+
+    # The items whose box intersects the box (x1, y1, x2, y2), bounds included
+    def intersects(self, x1, y1, x2, y2):
+        children = np.arange(self.capacity)
+        starts = np.zeros(1, dtype=int)
+        for (left, bottom, right, top), first in self.levels:
+            nodes = (starts[:, None] + children).reshape(-1)
+            nodes = nodes[(left[nodes] <= x2) & (x1 <= right[nodes]) & (bottom[nodes] <= y2) & (y1 <= top[nodes])]
+            if first is not None:
+                starts = first[nodes]
+        return self.items[nodes]
+
+
+# The permutation that sorts the boxes for STR packing
+def str_order(boxes, capacity):
+    count = len(boxes)
+    if count == 0:
+        return np.zeros(0, dtype=int)
+    centre_x = boxes[:, 0] + boxes[:, 2]
+    centre_y = boxes[:, 1] + boxes[:, 3]
+    slabs = int(ceil(sqrt(ceil(count / capacity))))
+    slab_size = slabs * capacity
+    rank = np.empty(count, dtype=int)
+    rank[np.argsort(centre_x, kind='stable')] = np.arange(count)
+    return np.lexsort((centre_y, rank // slab_size))
+
+
+# The x1, y1, x2, y2 columns of the boxes, with empty boxes (that contain no
+# point) up to a multiple of capacity
+def columns(boxes, capacity):
+    size = max(1, int(ceil(len(boxes) / capacity))) * capacity
+    padded = np.empty((size, 4))
+    padded[:len(boxes)] = boxes
+    padded[len(boxes):] = (np.inf, np.inf, -np.inf, -np.inf)
+    return tuple(np.ascontiguousarray(column) for column in padded.T)
+
+
+def box_contains(boxes, nodes, x, y):
+    x1, y1, x2, y2 = boxes
+    return (x1[nodes] <= x) & (x <= x2[nodes]) & (y1[nodes] <= y) & (y <= y2[nodes])
@@ -1,5 +1,6 @@
 from __future__ import division, print_function, absolute_import
 
+import re
 
 from lxml import etree
 from opendrivepy.road import Road, RoadLink
@@ -10,132 +11,182 @@ from opendrivepy.lane import Lanes, Lane, LaneLink, LaneSection, LaneWidth
 from OSMtype import Node,Way
 
 class XMLParser(object):
-    def __init__(self, file):
-        self.xml = etree.parse(file)
-        self.root = self.xml.getroot()
-    # add
+    def __init__(self, file, stream=False, max_error=None, road_cache=None):
+        self.xml = None
+        self.root = None
+        self.header = None
+        self.stream = stream
+        self.max_error = max_error  # chord error of adaptive sampling, None samples every metre
+        self.road_cache = road_cache
+        self.roads = None
+        self.junctions = None
 
-    def  parse_lonlat(self):
-        header=self.root.find("header")
+        if stream:
+            # Build roads and junctions while reading, without keeping the DOM
+            self.parse_stream(file)
+        else:
+            self.xml = etree.parse(file)
+            self.root = self.xml.getroot()
+            self.header = self.root.find("header")
+
+    # Reads the file with iterparse and turns every <road>/<junction> into its
+    # model object as soon as the element is closed. Processed elements are
+    # cleared and detached from the root, so only one record is alive at a time
+    def parse_stream(self, file):
+        self.roads = dict()
+        self.junctions = dict()
+
+        for _, element in etree.iterparse(file, events=('end',), tag=('header', 'road', 'junction')):
+            if element.tag == 'header':
+                # the header is small, keep it for parse_lonlat
+                self.header = element
+                continue
+            elif element.tag == 'road':
+                new_road = self.build_road(element)
+                self.roads[new_road.id] = new_road
+            else:
+                new_junction = self.build_junction(element)
+                self.junctions[new_junction.id] = new_junction
+
+            element.clear()
+            while element.getprevious() is not None:
+                del element.getparent()[0]
+
+    # The projection string of the header, None without one
+    def parse_georeference(self):
+        header=self.header
         if header is not None:
-            lonlat=header.find("geoReference")
-            if lonlat is not None:
-                return 121.2025854628344,31.29191979703701
+            georeference=header.find("geoReference")
+            if georeference is not None and georeference.text:
+                return georeference.text.strip()
+        return None
+
+    # The origin of the map, lon_0 and lat_0 of the geoReference
+    # Maps without them get the default origin
+    def parse_lonlat(self):
+        georeference=self.parse_georeference()
+        if georeference is not None:
+            lon=re.search(r'\+lon_0=(\S+)',georeference)
+            lat=re.search(r'\+lat_0=(\S+)',georeference)
+            if lon and lat:
+                return float(lon.group(1)),float(lat.group(1))
         return 121.2025854628344,31.29191979703701
     # Parses all roads in the xodr and instantiates them into objects
     # Returns a list of Road objects
     def parse_roads(self):
-        ret = dict()
+        if self.stream:
+            return self.roads
 
+        ret = dict()
         for road in self.root.iter('road'):
-
-            # Create the Road object
-            name = road.get('name')
-            length = road.get('length')
-            id = road.get('id')
-            junction = road.get('junction')
-
-            # Parses link for predecessor and successors
-            # No support for neighbor is implemented
-            link = road.find('link')
-            predecessor = None
-            successor = None
-            if link is not None:
-                xpredecessor = link.find('predecessor')
-                if xpredecessor is not None:
-                    element_type = xpredecessor.get('elementType')
-                    element_id = xpredecessor.get('elementId')
-                    contact_point = xpredecessor.get('contactPoint')
-                    predecessor = (RoadLink(element_type, element_id, contact_point))
-
-                xsuccessor = link.find('successor')
-                if xsuccessor is not None:
-                    element_type = xsuccessor.get('elementType')
-                    element_id = xsuccessor.get('elementId')
-                    contact_point = xsuccessor.get('contactPoint')
-                    successor = (RoadLink(element_type, element_id, contact_point))
-
-            # Parses planView for geometry records
-            xplan_view = road.find('planView')
-            plan_view = list()
-            for geometry in xplan_view.iter('geometry'):
-                record = geometry[0].tag
-
-                s = float(geometry.get('s'))
-                x = float(geometry.get('x'))
-                y = float(geometry.get('y'))
-                hdg = float(geometry.get('hdg'))
-                length = float(geometry.get('length'))
-
-                if record == 'line':
-                    plan_view.append(RoadLine(s, x, y, hdg, length))
-                elif record == 'arc':
-                    curvature = float(geometry[0].get('curvature'))
-                    plan_view.append(RoadArc(s, x, y, hdg, length, curvature))
-                elif record == 'spiral':
-                    curv_start = float(geometry[0].get('curvStart'))
-                    curv_end = float(geometry[0].get('curvEnd'))
-                    plan_view.append(RoadSpiral(s, x, y, hdg, length, curv_start, curv_end))
-
-            # Parses elevationProfile for geometry records
-            elevationProfile = road.find('elevationProfile')
-            elevations = list()
-            for elevation in elevationProfile.iter('elevation'):
-                record = geometry[0].tag
-
-                s = float(elevation.get('s'))
-                a = float(elevation.get('a'))
-                b = float(elevation.get('b'))
-                c = float(elevation.get('c'))
-                d = float(elevation.get('d'))
-                
-                elevations.append(RoadElevation(s,a,b,c,d))
-
-            # Parse lanes for lane
-            xlanes = road.find('lanes')
-            LaneSection_list=list()
-            s=None
-            for xlane_section in xlanes.iter('laneSection'):
-                #offset
-                s=float(xlane_section.get("s"))
-                # Center Lane
-                center = list()
-                xcenter = xlane_section.find('center')
-                if xcenter is not None:
-                    xlane = xcenter.find('lane')
-                    center.append(self.parse_lane(xlane))
-
-                # Left Lanes
-                left = list()
-                xleft = xlane_section.find('left')
-                if xleft is not None:
-                    for xlane in xleft.iter('lane'):
-                        left.append(self.parse_lane(xlane))
-
-                # Right Lanes
-                right = list()
-                xright = xlane_section.find('right')
-                if xright is not None:
-                    for xlane in xright.iter('lane'):
-                        right.append(self.parse_lane(xlane))
-
-                lane_section = LaneSection(left, center, right,s)
-                LaneSection_list.append(lane_section)
-            lanes = Lanes(LaneSection_list)
-
-            new_road = Road(name, length, id, junction, predecessor, successor, plan_view, elevations, lanes)
+            new_road = self.build_road(road)
             ret[new_road.id] = new_road
-            # if id=="100":
-            #     import matplotlib.pyplot as plt
-            #     list_x=list()
-            #     list_y=list()
-            #     for point in new_road.points:
-            #         list_x.append(point.x)
-            #         list_y.append(point.y)
-            #     plt.plot(list_x, list_y,"-o")
-            #     plt.show()
         return ret
 
+    # The Road of a <road> element, from the road cache when it did not change
+    def build_road(self, road):
+        if self.road_cache is None:
+            return self.parse_road(road)
+        return self.road_cache.record(road, self.parse_road)
+
+    # Instantiates a single <road> element into a Road object
+    def parse_road(self, road):
+        # Create the Road object
+        name = road.get('name')
+        length = road.get('length')
+        id = road.get('id')
+        junction = road.get('junction')
+
+        # Parses link for predecessor and successors
+        # No support for neighbor is implemented
+        link = road.find('link')
+        predecessor = None
+        successor = None
+        if link is not None:
+            xpredecessor = link.find('predecessor')
+            if xpredecessor is not None:
+                element_type = xpredecessor.get('elementType')
+                element_id = xpredecessor.get('elementId')
+                contact_point = xpredecessor.get('contactPoint')
+                predecessor = (RoadLink(element_type, element_id, contact_point))
+
+            xsuccessor = link.find('successor')
+            if xsuccessor is not None:
+                element_type = xsuccessor.get('elementType')
+                element_id = xsuccessor.get('elementId')
+                contact_point = xsuccessor.get('contactPoint')
+                successor = (RoadLink(element_type, element_id, contact_point))
+
+        # Parses planView for geometry records
+        xplan_view = road.find('planView')
+        plan_view = list()
+        for geometry in xplan_view.iter('geometry'):
+            record = geometry[0].tag
+
+            s = float(geometry.get('s'))
+            x = float(geometry.get('x'))
+            y = float(geometry.get('y'))
+            hdg = float(geometry.get('hdg'))
+            length = float(geometry.get('length'))
+
+            if record == 'line':
+                plan_view.append(RoadLine(s, x, y, hdg, length, self.max_error))
+            elif record == 'arc':
+                curvature = float(geometry[0].get('curvature'))
+                plan_view.append(RoadArc(s, x, y, hdg, length, curvature, self.max_error))
+            elif record == 'spiral':
+                curv_start = float(geometry[0].get('curvStart'))
+                curv_end = float(geometry[0].get('curvEnd'))
+                plan_view.append(RoadSpiral(s, x, y, hdg, length, curv_start, curv_end, self.max_error))
+
+        # Parses elevationProfile for geometry records
+        elevationProfile = road.find('elevationProfile')
+        elevations = list()
+        for elevation in elevationProfile.iter('elevation'):
+            record = geometry[0].tag
+
+            s = float(elevation.get('s'))
+            a = float(elevation.get('a'))
+            b = float(elevation.get('b'))
+            c = float(elevation.get('c'))
+            d = float(elevation.get('d'))
+            
+            elevations.append(RoadElevation(s,a,b,c,d))
+
+        # Parse lanes for lane
+        xlanes = road.find('lanes')
+        LaneSection_list=list()
+        s=None
+        for xlane_section in xlanes.iter('laneSection'):
+            #offset
+            s=float(xlane_section.get("s"))
+            # Center Lane
+            center = list()
+            xcenter = xlane_section.find('center')
+            if xcenter is not None:
+                xlane = xcenter.find('lane')
+                center.append(self.parse_lane(xlane))
+
+            # Left Lanes
+            left = list()
+            xleft = xlane_section.find('left')
+            if xleft is not None:
+                for xlane in xleft.iter('lane'):
+                    left.append(self.parse_lane(xlane))
+
+            # Right Lanes
+            right = list()
+            xright = xlane_section.find('right')
+            if xright is not None:
+                for xlane in xright.iter('lane'):
+                    right.append(self.parse_lane(xlane))
+
+            lane_section = LaneSection(left, center, right,s)
+            LaneSection_list.append(lane_section)
+        lanes = Lanes(LaneSection_list)
+
+        return Road(name, length, id, junction, predecessor, successor, plan_view, elevations, lanes)
+
     def parse_lane(self, xlane):
 
         # Attributes
@@ -174,20 +225,33 @@ class XMLParser(object):
 
     # TODO Add Priorities, JunctionGroups and LaneLinks
     def parse_junctions(self):
-        ret = dict()
+        if self.stream:
+            return self.junctions
 
+        ret = dict()
         for junction in self.root.iter('junction'):
-            new_junction = Junction(junction.get('name'), junction.get('id'))
+            new_junction = self.build_junction(junction)
+            ret[new_junction.id] = new_junction
+
+        return ret
 
-            for connection in junction.iter('connection'):
-                id = connection.get('id')
-                incoming_road = connection.get('incomingRoad')
-                connecting_road = connection.get('connectingRoad')
-                contact_point = connection.get('contactPoint')
-                new_connection = Connection(id, incoming_road, connecting_road, contact_point)
+    # The Junction of a <junction> element, from the road cache when it did not change
+    def build_junction(self, junction):
+        if self.road_cache is None:
+            return self.parse_junction(junction)
+        return self.road_cache.record(junction, self.parse_junction)
 
-                new_junction.add_connection(new_connection)
+    # Instantiates a single <junction> element into a Junction object
+    def parse_junction(self, junction):
+        new_junction = Junction(junction.get('name'), junction.get('id'))
 
-            ret[new_junction.id] = new_junction
+        for connection in junction.iter('connection'):
+            id = connection.get('id')
+            incoming_road = connection.get('incomingRoad')
+            connecting_road = connection.get('connectingRoad')
+            contact_point = connection.get('contactPoint')
+            new_connection = Connection(id, incoming_road, connecting_road, contact_point)
 
-        return ret
+            new_junction.add_connection(new_connection)
+
+        return new_junction